@@ -1,23 +1,170 @@
 import os
+import json
+import time
 import random
-import subprocess
 import tempfile
+import threading
 import gradio as gr
 from huggingface_hub import snapshot_download, HfFileSystem, ModelCard
+from inference import load_pipeline, generate_batch, warmup, GenerationRequest
+from hotshot_xl.batching import MicroBatcher
+from hotshot_xl.lora_cache import LoraCache
 
 SECRET_TOKEN = os.getenv('SECRET_TOKEN', 'default_secret')
 
 fs = HfFileSystem()
 
-# execute a CLI command
-def execute_command(command: str) -> None:
-    subprocess.run(command, check=True)
+SIZES = [
+    '320x768',
+    '384x672',
+    '416x608',
+    '512x512',
+    '608x416',
+    '672x384',
+    '768x320',
+    '1024x1024',
+    '1024x512',
+    '1024x576'
+]
 
-def get_trigger_word(lora_id):
-    # Get instance_prompt a.k.a trigger word
+WARMUP_VIDEO_LENGTHS = [int(length) for length in os.getenv('WARMUP_VIDEO_LENGTHS', '8').split(',')]
+WARMUP_BATCH_SIZES = [int(batch_size) for batch_size in os.getenv('WARMUP_BATCH_SIZES', '1').split(',')]
+
+# every size, length and batch size is a separate compiled graph. steps without classifier free guidance (see
+# `cfg_end`) run the unet with half the batch, which doubles the number of unet input shapes
+COMPILE_MAX_SHAPES = int(os.getenv(
+    'COMPILE_MAX_SHAPES',
+    2 * len(SIZES) * len(WARMUP_VIDEO_LENGTHS) * len(WARMUP_BATCH_SIZES),
+))
+
+# the pipeline is loaded once and kept in memory for the lifetime of the server. with COMPILE=1 the unet and vae
+# are compiled, COMPILE_CACHE_DIR keeps the compiled kernels across restarts
+pipe = load_pipeline(
+    compile_models=os.getenv('COMPILE', '0') == '1',
+    compile_cache_dir=os.getenv('COMPILE_CACHE_DIR'),
+    compile_max_shapes=COMPILE_MAX_SHAPES,
+)
+# most requests share the default negative prompt, so its text embeddings are only computed once
+pipe.enable_prompt_embedding_cache(max_entries=int(os.getenv('PROMPT_CACHE_MAX_ENTRIES', 64)))
+
+# parsed LoRA weights are kept on the CPU so switching between popular LoRAs doesn't hit the disk or the Hub
+lora_cache = LoraCache(max_bytes=int(os.getenv('LORA_CACHE_MAX_BYTES', 2 * 1024 ** 3)))
+
+# concurrent requests with the same size, length, steps and LoRA are denoised together in one batch.
+# the batcher runs all generations on its own thread, so that is the only thread using the pipeline
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 4))
+
+# with LOW_VRAM_MODE=1 only the components needed for the current stage are kept on the GPU. components are only
+# offloaded until OFFLOAD_RESERVE_BYTES are free, so on larger GPUs they stay resident between requests
+LOW_VRAM_MODE = os.getenv('LOW_VRAM_MODE', '0') == '1'
+OFFLOAD_RESERVE_BYTES = int(os.environ['OFFLOAD_RESERVE_BYTES']) if 'OFFLOAD_RESERVE_BYTES' in os.environ else None
+
+batcher = MicroBatcher(
+    run_batch=lambda requests: generate_batch(pipe, requests, lora_cache=lora_cache),
+    key_fn=GenerationRequest.batch_key,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait=float(os.getenv('BATCH_MAX_WAIT', 0.1)),
+)
+
+# with WARMUP=1 every advertised size is generated once at startup, so the first request at each size doesn't
+# pay for tracing and compilation
+if os.getenv('WARMUP', '0') == '1':
+    warmup(
+        pipe,
+        sizes=[tuple(map(int, size.split('x'))) for size in SIZES],
+        video_lengths=WARMUP_VIDEO_LENGTHS,
+        batch_sizes=WARMUP_BATCH_SIZES,
+        low_vram_mode=LOW_VRAM_MODE,
+        offload_reserve_bytes=OFFLOAD_RESERVE_BYTES,
+    )
+
+class HubMetadataCache:
+    """
+    TTL cache for small pieces of Hub metadata (trigger words, weight file names), so the request path doesn't
+    wait on the Hub every time.
+
+    Fresh entries are served from memory. Expired entries are still served right away and refreshed in a
+    background thread. In offline mode entries never expire and nothing is fetched from the Hub. When `path`
+    is set, the entries are also persisted to that JSON file and reloaded on startup.
+    """
+
+    def __init__(self, ttl: float = 3600, path: str = None, offline: bool = False):
+        self.ttl = ttl
+        self.path = path
+        self.offline = offline
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read hub metadata cache {path}: {e}")
+
+    def get(self, key, fetch):
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None:
+            if not self.offline and time.time() - entry["time"] > self.ttl:
+                self._refresh_in_background(key, fetch)
+            return entry["value"]
+
+        if self.offline:
+            raise RuntimeError(f"{key} is not cached and the Hub is in offline mode")
+
+        return self._fetch(key, fetch)
+
+    def _fetch(self, key, fetch):
+        value = fetch()
+        with self._lock:
+            self._entries[key] = {"value": value, "time": time.time()}
+            self._save()
+        return value
+
+    def _refresh_in_background(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch(key, fetch)
+            except Exception as e:
+                # keep serving the stale entry
+                print(f"Could not refresh {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+
+hub_cache = HubMetadataCache(
+    ttl=float(os.getenv('HUB_CACHE_TTL', 3600)),
+    path=os.getenv('HUB_CACHE_PATH'),
+    offline=os.getenv('HF_HUB_OFFLINE', '0') == '1',
+)
+
+def fetch_instance_prompt(lora_id):
     card = ModelCard.load(lora_id)
     repo_data = card.data.to_dict()
-    instance_prompt = repo_data.get("instance_prompt")
+    return repo_data.get("instance_prompt")
+
+def get_trigger_word(lora_id):
+    # Get instance_prompt a.k.a trigger word
+    instance_prompt = hub_cache.get(f"instance_prompt:{lora_id}", lambda: fetch_instance_prompt(lora_id))
 
     if instance_prompt is not None:
         print(f"Trigger word: {instance_prompt}")
@@ -42,10 +189,14 @@ def get_files(file_paths):
     return result
 
 
-def load_lora_weights(lora_id):
+def fetch_safetensors_files(lora_id):
     # List all ".safetensors" files in repo
     sfts_available_files = fs.glob(f"{lora_id}/*safetensors")
-    sfts_available_files = get_files(sfts_available_files)
+    return get_files(sfts_available_files)
+
+
+def load_lora_weights(lora_id):
+    sfts_available_files = hub_cache.get(f"safetensors:{lora_id}", lambda: fetch_safetensors_files(lora_id))
 
     if sfts_available_files == []:
         sfts_available_files = ["NO SAFETENSORS FILE"]
@@ -76,28 +227,23 @@ def infer(secret_token: str, prompt: str, negative_prompt: str, lora: str = None
     with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as tf:
         output = tf.name
 
-    command = [
-      f"python", 
-      f"inference.py",
-      f"--prompt={prompt}",
-      f"--negative_prompt={negative_prompt}",
-      f"--output={output}",
-      f"--width={width}",
-      f"--height={height}",
-      f"--seed={seed}",
-      f"--steps={steps}",
-      f"--video_length={video_length}",
-      f"--video_duration={video_duration}",
-    ]
-
-    if lora:
-        #command.append(f"--spatial_unet_base={spatial_unet_base}")
-        command.append(f"--lora={lora_path}")
-        command.append(f"--weight_name={lora_weights}")
-
-    execute_command(command)
-
-    return output
+    request = GenerationRequest(
+        output=output,
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        lora=lora_path,
+        weight_name=lora_weights if lora else None,
+        width=width,
+        height=height,
+        seed=int(seed),
+        steps=int(steps),
+        video_length=int(video_length),
+        video_duration=int(video_duration),
+        low_vram_mode=LOW_VRAM_MODE,
+        offload_reserve_bytes=OFFLOAD_RESERVE_BYTES,
+    )
+
+    return batcher.submit(request).result()
     
 with gr.Blocks() as demo:
     with gr.Column(elem_id="col-container"):
@@ -121,18 +267,7 @@ with gr.Blocks() as demo:
             with gr.Row():
                 size = gr.Dropdown(
                     label="Size",
-                    choices=[
-                        '320x768',
-                        '384x672',
-                        '416x608',
-                        '512x512',
-                        '608x416',
-                        '672x384',
-                        '768x320',
-                        '1024x1024',
-                        '1024x512',
-                        '1024x576'
-                    ], value='512x512')
+                    choices=SIZES, value='512x512')
                 
                 seed = gr.Slider(
                     label="Seed",
@@ -171,4 +306,5 @@ with gr.Blocks() as demo:
     lora.blur(fn=get_trigger_word, inputs=[lora], outputs=[lora_trigger], queue=False)
     submit_btn.click(fn=infer, inputs=[secret_token, prompt, negative_prompt, lora, size, seed, steps, video_length, video_duration], outputs=[mp4_result])
 
-demo.queue(max_size=12).launch()
+# let up to MAX_BATCH_SIZE requests wait in the batcher at the same time so they can be coalesced
+demo.queue(max_size=12, concurrency_count=MAX_BATCH_SIZE).launch()
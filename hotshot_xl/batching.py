@@ -0,0 +1,85 @@
+# Copyright 2023 Natural Synthetics Inc. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List
+
+
+class MicroBatcher:
+    """
+    Coalesces items submitted from many threads into batches and runs them on a single worker thread.
+
+    Only items with the same `key_fn(item)` end up in the same batch. The oldest pending item decides which key
+    is served next, and the worker waits at most `max_wait` seconds for more compatible items to arrive before
+    running a batch that isn't full yet. `run_batch` receives a list of items and must return one result per
+    item, in the same order.
+    """
+
+    def __init__(self,
+                 run_batch: Callable[[List[Any]], List[Any]],
+                 key_fn: Callable[[Any], Hashable],
+                 max_batch_size: int = 4,
+                 max_wait: float = 0.1):
+        if max_batch_size < 1:
+            raise ValueError(f"`max_batch_size` has to be at least 1 but is {max_batch_size}")
+
+        self.run_batch = run_batch
+        self.key_fn = key_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._cond:
+            self._pending.append((item, self.key_fn(item), future))
+            self._cond.notify_all()
+        return future
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            key = self._pending[0][1]
+            deadline = time.monotonic() + self.max_wait
+
+            while True:
+                batch = [p for p in self._pending if p[1] == key][:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            taken = set(id(p) for p in batch)
+            self._pending = [p for p in self._pending if id(p) not in taken]
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            # drop items whose caller gave up while they were queued
+            batch = [p for p in batch if p[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                results = self.run_batch([item for item, _, _ in batch])
+            except BaseException as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
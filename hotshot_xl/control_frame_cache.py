@@ -0,0 +1,95 @@
+# Copyright 2023 Natural Synthetics Inc. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+from typing import List
+
+import numpy as np
+import requests
+from PIL import Image
+
+from hotshot_xl.utils import extract_gif_frames_from_midpoint, scale_aspect_fill
+
+# bump when the way the frames are extracted or resized changes, so stale entries aren't reused
+_CACHE_VERSION = 1
+
+
+def read_gif_bytes(gif: str) -> bytes:
+    if gif.startswith("http"):
+        response = requests.get(gif)
+        response.raise_for_status()
+        return response.content
+    if os.path.exists(gif):
+        with open(gif, "rb") as f:
+            return f.read()
+    raise Exception("File not found")
+
+
+def extract_control_frames(data: bytes, fps: int, target_duration: int, width: int, height: int) -> np.ndarray:
+    """
+    Decodes the gif in `data`, picks the frames like `extract_gif_frames_from_midpoint` and scales them with
+    `scale_aspect_fill`. Returns the frames as an (f, h, w, 3) uint8 array.
+    """
+    frames = extract_gif_frames_from_midpoint(Image.open(BytesIO(data)), fps=fps, target_duration=target_duration)
+    return np.stack([np.asarray(scale_aspect_fill(frame, width, height).convert("RGB")) for frame in frames])
+
+
+class ControlFrameCache:
+    """
+    On-disk cache of the control frames extracted from a gif.
+
+    Entries are keyed by a hash of the gif's content together with `fps`, `target_duration`, `width` and `height`,
+    so a renamed or re-downloaded gif still hits the cache and an edited one doesn't. The frames are stored as an
+    uncompressed (f, h, w, 3) uint8 `.npy` file and memory mapped when they are read, so a hit skips decoding the
+    gif and resizing its frames. Entries are written to a temporary file first and renamed into place, which
+    makes it safe to share `cache_dir` between processes.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, data: bytes, fps: int, target_duration: int, width: int, height: int) -> str:
+        key = hashlib.sha256(data)
+        key.update(f"v{_CACHE_VERSION}-{fps}-{target_duration}-{int(width)}x{int(height)}".encode())
+        return os.path.join(self.cache_dir, key.hexdigest() + ".npy")
+
+    def load(self, gif: str, fps: int = 8, target_duration: int = 1000, width: int = 512, height: int = 512) -> np.ndarray:
+        """
+        Returns the control frames of `gif` (a path or URL) as a read only, memory mapped (f, h, w, 3) uint8
+        array, extracting and caching them on a miss.
+        """
+        data = read_gif_bytes(gif)
+        path = self.path(data, fps, target_duration, width, height)
+
+        if os.path.exists(path):
+            try:
+                return np.load(path, mmap_mode="r")
+            except (OSError, ValueError):
+                # a truncated or otherwise unreadable entry is simply extracted again
+                pass
+
+        frames = extract_control_frames(data, fps, target_duration, width, height)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".npy.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, frames)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return np.load(path, mmap_mode="r")
+
+    def load_images(self, gif: str, fps: int = 8, target_duration: int = 1000, width: int = 512,
+                    height: int = 512) -> List[Image.Image]:
+        return [Image.fromarray(frame) for frame in self.load(gif, fps, target_duration, width, height)]
@@ -0,0 +1,112 @@
+# Copyright 2023 Natural Synthetics Inc. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import torch
+
+
+class LoraCache:
+    """
+    LRU cache of parsed LoRA state dicts, keyed by Hub repo id (or local path) and weight file name.
+
+    The state dicts are kept on the CPU and the cache is bounded by the total number of bytes of the cached
+    tensors. `activate` attaches an adapter to a resident pipeline without reloading the base model, and
+    remembers which adapter is attached so asking for the same one again is a no-op.
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._active = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Tuple[str, Optional[str]]):
+        return key in self._entries
+
+    def get(self, pipe, lora_id: str, weight_name: Optional[str] = None) -> Tuple[Dict[str, torch.Tensor], Optional[Dict[str, float]]]:
+        """
+        Returns `(state_dict, network_alphas)` for the given LoRA, parsing it with `pipe.lora_state_dict`
+        on a cache miss.
+        """
+        key = (lora_id, weight_name)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                state_dict, network_alphas, _ = self._entries[key]
+                return state_dict, network_alphas
+
+        kwargs = {"low_cpu_mem_usage": True}
+        if weight_name is not None:
+            kwargs["weight_name"] = weight_name
+
+        state_dict, network_alphas = pipe.lora_state_dict(lora_id, unet_config=pipe.unet.config, **kwargs)
+        state_dict = {k: v.to("cpu") for k, v in state_dict.items()}
+        num_bytes = sum(v.numel() * v.element_size() for v in state_dict.values())
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (state_dict, network_alphas, num_bytes)
+                self._size += num_bytes
+                self._evict()
+
+        return state_dict, network_alphas
+
+    def _evict(self):
+        # always keep the most recently used entry, even if it's larger than the budget on its own
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, (_, _, num_bytes) = self._entries.popitem(last=False)
+            self._size -= num_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def active(self, pipe) -> Optional[Tuple[str, Optional[str]]]:
+        return self._active.get(pipe)
+
+    def activate(self, pipe, lora_id: Optional[str] = None, weight_name: Optional[str] = None):
+        """
+        Makes the given LoRA the only adapter attached to `pipe`. Passing `lora_id=None` detaches the
+        current adapter, if any.
+        """
+        key = (lora_id, weight_name) if lora_id else None
+
+        if self._active.get(pipe) == key:
+            return
+
+        self.deactivate(pipe)
+
+        if key is None:
+            return
+
+        state_dict, network_alphas = self.get(pipe, lora_id, weight_name)
+        try:
+            pipe.load_parsed_lora_weights(state_dict, network_alphas=network_alphas)
+        except Exception:
+            # don't leave a half attached adapter behind
+            pipe.unload_lora_weights()
+            raise
+        self._active[pipe] = key
+
+    def deactivate(self, pipe):
+        if self._active.pop(pipe, None) is not None:
+            pipe.unload_lora_weights()
@@ -6,14 +6,48 @@
 #     http://www.apache.org/licenses/LICENSE-2.0
 #
 
+from typing import Optional
+
 import torch
 import torch.nn as nn
 from diffusers.models.resnet import Upsample2D, Downsample2D, LoRACompatibleConv
 from einops import rearrange
 
 
+# The 3D layers below apply their 2D counterpart to every frame. 4D inputs (single images, or videos folded to
+# `(b f) c h w` by the unet) are passed straight through, which lets the unet run them without any reshaping.
+
+
+def group_norm_frames(norm: nn.GroupNorm, hidden_states: torch.Tensor, num_frames: Optional[int] = None):
+    """
+    Applies `norm` with statistics shared by all frames of a video, also when the video is folded to
+    `(b f) c h w`, in which case `num_frames` has to be given. Works on channels last inputs without copying them.
+    """
+    if num_frames is None or hidden_states.ndim != 4:
+        return norm(hidden_states)
+
+    batch_frames, channels, height, width = hidden_states.shape
+    groups = norm.num_groups
+    shape = (batch_frames // num_frames, num_frames, groups, channels // groups, height, width)
+    hidden_states = hidden_states.view(shape)
+
+    var, mean = torch.var_mean(hidden_states, dim=(1, 3, 4, 5), unbiased=False, keepdim=True)
+    scale = torch.rsqrt(var + norm.eps)
+    shift = -mean * scale
+
+    if norm.affine:
+        weight = norm.weight.view(1, 1, groups, channels // groups, 1, 1)
+        bias = norm.bias.view(1, 1, groups, channels // groups, 1, 1)
+        scale = scale * weight
+        shift = shift * weight + bias
+
+    return torch.addcmul(shift, hidden_states, scale).reshape(batch_frames, channels, height, width)
+
 class Upsample3D(Upsample2D):
     def forward(self, hidden_states, output_size=None, scale: float = 1.0):
+        if hidden_states.ndim == 4:
+            return super(Upsample3D, self).forward(hidden_states, output_size, scale)
+
         f = hidden_states.shape[2]
         hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
         hidden_states = super(Upsample3D, self).forward(hidden_states, output_size, scale)
@@ -23,6 +57,9 @@ class Upsample3D(Upsample2D):
 class Downsample3D(Downsample2D):
 
     def forward(self, hidden_states, scale: float = 1.0):
+        if hidden_states.ndim == 4:
+            return super(Downsample3D, self).forward(hidden_states, scale)
+
         f = hidden_states.shape[2]
         hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
         hidden_states = super(Downsample3D, self).forward(hidden_states, scale)
@@ -31,6 +68,9 @@ class Downsample3D(Downsample2D):
 
 class Conv3d(LoRACompatibleConv):
     def forward(self, hidden_states, scale: float = 1.0):
+        if hidden_states.ndim == 4:
+            return super().forward(hidden_states, scale)
+
         f = hidden_states.shape[2]
         hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
         hidden_states = super().forward(hidden_states, scale)
@@ -100,22 +140,24 @@ class ResnetBlock3D(nn.Module):
                 in_channels, out_channels, kernel_size=1, stride=1, padding=0, bias=conv_shortcut_bias
             )
 
-    def forward(self, input_tensor, temb):
+    def forward(self, input_tensor, temb, num_frames: Optional[int] = None):
         hidden_states = input_tensor
 
-        hidden_states = self.norm1(hidden_states)
+        hidden_states = group_norm_frames(self.norm1, hidden_states, num_frames)
         hidden_states = self.nonlinearity(hidden_states)
 
         hidden_states = self.conv1(hidden_states)
 
         if temb is not None:
             temb = self.nonlinearity(temb)
-            temb = self.time_emb_proj(temb)[:, :, None, None, None]
+            temb = self.time_emb_proj(temb)
+            # broadcast over (h, w) for images and (f, h, w) for videos
+            temb = temb.reshape(temb.shape + (1,) * (hidden_states.ndim - 2))
 
         if temb is not None and self.time_embedding_norm == "default":
             hidden_states = hidden_states + temb
 
-        hidden_states = self.norm2(hidden_states)
+        hidden_states = group_norm_frames(self.norm2, hidden_states, num_frames)
 
         if temb is not None and self.time_embedding_norm == "scale_shift":
             scale, shift = torch.chunk(temb, 2, dim=1)
@@ -55,7 +55,9 @@ class Transformer3DModel(Transformer2DModel):
         if is_video:
             f = hidden_states.shape[2]
             hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
-            encoder_hidden_states = repeat(encoder_hidden_states, 'b n c -> (b f) n c', f=f)
+            # the unet passes the text embeddings already expanded to every frame
+            if encoder_hidden_states is not None and encoder_hidden_states.shape[0] != hidden_states.shape[0]:
+                encoder_hidden_states = repeat(encoder_hidden_states, 'b n c -> (b f) n c', f=f)
 
         hidden_states = super(Transformer3DModel, self).forward(hidden_states,
                                                                 encoder_hidden_states,
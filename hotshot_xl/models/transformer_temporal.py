@@ -10,16 +10,31 @@ import torch
 import math
 from dataclasses import dataclass
 from torch import nn
+import torch.nn.functional as F
 from diffusers.utils import BaseOutput
 from diffusers.models.attention import Attention, FeedForward
+from diffusers.models.attention_processor import AttnProcessor2_0
 from einops import rearrange, repeat
 from typing import Optional
 
 
+def _is_compiling() -> bool:
+    if hasattr(torch, "compiler") and hasattr(torch.compiler, "is_compiling"):
+        return torch.compiler.is_compiling()
+    try:
+        from torch._dynamo import is_compiling
+    except ImportError:
+        return False
+    return is_compiling()
+
+
 class PositionalEncoding(nn.Module):
     """
     Implements positional encoding as described in "Attention Is All You Need".
     Adds sinusoidal based positional encodings to the input tensor.
+
+    The encoding for each `(length, dtype, device)` is materialized once and reused. Lengths beyond `max_length`
+    extend the table lazily, the registered buffer itself stays unchanged.
     """
 
     _SCALE_FACTOR = 10000.0  # Scale factor used in the positional encoding computation.
@@ -27,25 +42,144 @@ class PositionalEncoding(nn.Module):
     def __init__(self, dim: int, dropout: float = 0.0, max_length: int = 24):
         super(PositionalEncoding, self).__init__()
 
+        self.dim = dim
         self.dropout = nn.Dropout(p=dropout)
 
         # The size is (1, max_length, dim) to allow easy addition to input tensors.
-        positional_encoding = torch.zeros(1, max_length, dim)
+        positional_encoding = self._sinusoids(0, max_length, dim)
+
+        # Register the positional encoding matrix as a buffer,
+        # so it's part of the model's state but not the parameters.
+        self.register_buffer('positional_encoding', positional_encoding)
+
+        self._encodings = {}
+
+    @classmethod
+    def _sinusoids(cls, start: int, end: int, dim: int) -> torch.Tensor:
+        positional_encoding = torch.zeros(1, end - start, dim)
 
         # Position and dim are used in the sinusoidal computation.
-        position = torch.arange(max_length).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, dim, 2) * (-math.log(self._SCALE_FACTOR) / dim))
+        position = torch.arange(start, end).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, dim, 2) * (-math.log(cls._SCALE_FACTOR) / dim))
 
         positional_encoding[0, :, 0::2] = torch.sin(position * div_term)
         positional_encoding[0, :, 1::2] = torch.cos(position * div_term)
 
-        # Register the positional encoding matrix as a buffer,
-        # so it's part of the model's state but not the parameters.
-        self.register_buffer('positional_encoding', positional_encoding)
+        return positional_encoding
+
+    def _apply(self, fn, *args, **kwargs):
+        # the cached encodings are derived from the buffer, drop them when it is moved or cast
+        self._encodings = {}
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._encodings = {}
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def get_encoding(self, length: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        """
+        Returns the `(1, length, dim)` positional encoding in `dtype` on `device`.
+        """
+        # inside a compiled graph the encoding is computed by the graph itself, without touching the cache
+        compiling = _is_compiling()
+        key = (length, dtype, torch.device(device))
+        encoding = None if compiling else self._encodings.get(key)
+
+        if encoding is None:
+            max_length = self.positional_encoding.shape[1]
+            if length <= max_length:
+                encoding = self.positional_encoding[:, :length]
+            else:
+                extension = self._sinusoids(max_length, length, self.dim).to(self.positional_encoding)
+                encoding = torch.cat([self.positional_encoding, extension], dim=1)
+
+            encoding = encoding.to(device=device, dtype=dtype).contiguous()
+            if not compiling:
+                self._encodings[key] = encoding
+
+        return encoding
+
+    def forward(self, hidden_states: torch.Tensor, length: int, inplace: bool = False) -> torch.Tensor:
+        """
+        Adds the encoding to `hidden_states`, whose frames are on dim 1: `(b, f, c)` or `(b, f, ..., c)`.
+
+        With `inplace`, the caller gives up `hidden_states` and the encoding is added to it in place whenever
+        autograd doesn't need the original values.
+        """
+        encoding = self.get_encoding(length, hidden_states.dtype, hidden_states.device)
+        encoding = encoding.view((1, length) + (1,) * (hidden_states.ndim - 3) + (self.dim,))
+
+        if inplace and not (torch.is_grad_enabled() and hidden_states.requires_grad):
+            hidden_states = hidden_states.add_(encoding)
+        else:
+            hidden_states = hidden_states + encoding
+
+        # dropout is a no-op at inference (and at p=0), skip it entirely
+        if self.training and self.dropout.p > 0:
+            hidden_states = self.dropout(hidden_states)
+
+        return hidden_states
+
+
+class TemporalAttnProcessor2_0:
+    r"""
+    Processor for `TemporalAttention` self attention, using PyTorch 2.0's scaled dot product attention.
+
+    Works on the `(b f) s c` layout of the spatial layers directly: the positional encoding is added on a
+    `(b, f, s, c)` view, and the frames of every spatial position are attended through strided
+    `(b, s * heads, f, head_dim)` views of the projections, instead of rearranging the hidden states to
+    `(b s) f c` and back. With `inplace_input`, the positional encoding is added to the input in place.
+    """
+
+    def __init__(self):
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise ImportError("TemporalAttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0.")
+
+    def __call__(
+        self,
+        attn: "TemporalAttention",
+        hidden_states: torch.FloatTensor,
+        number_of_frames: int = 8,
+        inplace_input: bool = False,
+    ):
+        batch_frames, sequence_length, channels = hidden_states.shape
+        batch_size = batch_frames // number_of_frames
+
+        hidden_states = hidden_states.reshape(batch_size, number_of_frames, sequence_length, channels)
+        hidden_states = attn.pos_encoder(hidden_states, length=number_of_frames, inplace=inplace_input)
+        hidden_states = hidden_states.view(batch_frames, sequence_length, channels)
 
-    def forward(self, hidden_states: torch.Tensor, length: int) -> torch.Tensor:
-        hidden_states = hidden_states + self.positional_encoding[:, :length]
-        return self.dropout(hidden_states)
+        residual = hidden_states
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        # (b f) s (h d) -> b (s h) f d, without copying
+        query, key, value = (
+            t.view(batch_size, number_of_frames, sequence_length * attn.heads, head_dim).transpose(1, 2)
+            for t in (query, key, value)
+        )
+
+        hidden_states = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_frames, sequence_length, inner_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
 
 
 class TemporalAttention(Attention):
@@ -53,10 +187,24 @@ class TemporalAttention(Attention):
         super().__init__(*args, **kwargs)
         self.pos_encoder = PositionalEncoding(kwargs["query_dim"], dropout=0)
 
-    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, number_of_frames=8):
+        # replace the generic default processor with the one working on the temporal layout directly
+        if kwargs.get("processor") is None and isinstance(self.processor, AttnProcessor2_0):
+            self.set_processor(TemporalAttnProcessor2_0())
+
+    def forward(
+        self, hidden_states, encoder_hidden_states=None, attention_mask=None, number_of_frames=8, inplace_input=False
+    ):
+        # with `inplace_input`, the caller doesn't use `hidden_states` afterwards and the positional encoding may be
+        # added to it in place
+        if isinstance(self.processor, TemporalAttnProcessor2_0) and encoder_hidden_states is None and attention_mask is None:
+            return self.processor(
+                self, hidden_states, number_of_frames=number_of_frames, inplace_input=inplace_input
+            )
+
+        # any other processor (xformers, sliced, LoRA, ...) runs on the rearranged (b s) f c layout
         sequence_length = hidden_states.shape[1]
         hidden_states = rearrange(hidden_states, "(b f) s c -> (b s) f c", f=number_of_frames)
-        hidden_states = self.pos_encoder(hidden_states, length=number_of_frames)
+        hidden_states = self.pos_encoder(hidden_states, length=number_of_frames, inplace=inplace_input)
 
         if encoder_hidden_states:
             encoder_hidden_states = repeat(encoder_hidden_states, "b n c -> (b s) n c", s=sequence_length)
@@ -109,9 +257,16 @@ class TransformerTemporal(nn.Module):
         )
         self.proj_out = nn.Linear(inner_dim, in_channels)
 
-    def forward(self, hidden_states, encoder_hidden_states=None):
-        _, num_channels, f, height, width = hidden_states.shape
-        hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
+    def forward(self, hidden_states, encoder_hidden_states=None, num_frames: Optional[int] = None):
+        # videos are either (b, c, f, h, w) or already folded to ((b f), c, h, w), with `num_frames` frames
+        is_folded = hidden_states.ndim == 4
+
+        if is_folded:
+            _, num_channels, height, width = hidden_states.shape
+            f = num_frames
+        else:
+            _, num_channels, f, height, width = hidden_states.shape
+            hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
 
         skip = hidden_states
 
@@ -123,10 +278,15 @@ class TransformerTemporal(nn.Module):
             hidden_states = block(hidden_states, encoder_hidden_states=encoder_hidden_states, number_of_frames=f)
 
         hidden_states = self.proj_out(hidden_states)
-        hidden_states = rearrange(hidden_states, "bf (h w) c -> bf c h w", h=height, w=width).contiguous()
+        hidden_states = rearrange(hidden_states, "bf (h w) c -> bf c h w", h=height, w=width)
+        # the rearranged view already is channels last, only copy it for channels first inputs
+        if not (is_folded and skip.is_contiguous(memory_format=torch.channels_last)):
+            hidden_states = hidden_states.contiguous()
 
         output = hidden_states + skip
-        output = rearrange(output, "(b f) c h w -> b c f h w", f=f)
+
+        if not is_folded:
+            output = rearrange(output, "(b f) c h w -> b c f h w", f=f)
 
         return output
 
@@ -178,11 +338,13 @@ class TransformerBlock(nn.Module):
 
         for block, norm in zip(self.attention_blocks, self.norms):
             norm_hidden_states = norm(hidden_states)
+            # `norm_hidden_states` isn't used after the attention, so the positional encoding can be added in place
             hidden_states = block(
                 norm_hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 attention_mask=attention_mask,
-                number_of_frames=number_of_frames
+                number_of_frames=number_of_frames,
+                inplace_input=True,
             ) + hidden_states
 
         norm_hidden_states = self.ff_norm(hidden_states)
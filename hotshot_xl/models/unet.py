@@ -22,10 +22,11 @@ from typing import Any, Dict, List, Optional, Tuple, Union
 import torch
 import torch.nn as nn
 import torch.utils.checkpoint
+from einops import rearrange
 
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.loaders import UNet2DConditionLoadersMixin
-from diffusers.utils import BaseOutput, logging
+from diffusers.utils import BaseOutput, is_torch_version, logging
 from diffusers.models.activations import get_activation
 from diffusers.models.attention_processor import AttentionProcessor, AttnProcessor
 from diffusers.models.embeddings import (
@@ -52,11 +53,20 @@ from .unet_blocks import (
     get_up_block,
 )
 
-from .resnet import Conv3d
+from .resnet import Conv3d, group_norm_frames
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
+def _allow_einops_in_compiled_graph():
+    # lets TorchDynamo trace through einops instead of breaking the graph on every rearrange
+    try:
+        from einops._torch_specific import allow_ops_in_compiled_graph
+    except ImportError:  # einops < 0.6.1
+        return
+    allow_ops_in_compiled_graph()
+
+
 @dataclass
 class UNet3DConditionOutput(BaseOutput):
     """
@@ -476,6 +486,101 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         self.conv_out = Conv3d(block_out_channels[0], out_channels, kernel_size=conv_out_kernel,
                                padding=conv_out_padding)
 
+        # decided once here instead of on every forward pass, so the forward pass doesn't inspect the blocks
+        self._down_blocks_cross_attention = tuple(
+            getattr(block, "has_cross_attention", False) for block in self.down_blocks
+        )
+        self._up_blocks_cross_attention = tuple(
+            getattr(block, "has_cross_attention", False) for block in self.up_blocks
+        )
+
+        self.deep_cache_depth = None
+        self._deep_cache = None
+        self.folded_frame_layout = False
+
+    def enable_folded_frame_layout(self, channels_last: bool = False):
+        r"""
+        Folds the frames of a video into the batch once, before `conv_in`, and keeps the activations in a
+        `(batch * frames, channels, height, width)` layout until after `conv_out`. The spatial layers then run on
+        the folded activations directly instead of rearranging them to and from `(batch, channels, frames, height,
+        width)` around every convolution, and only the temporal layers look at the frames axis.
+
+        With `channels_last`, the weights of the convolutions are converted to the channels last memory format, so
+        the activations stay channels last between consecutive spatial layers as well.
+        """
+        self.folded_frame_layout = True
+        self._deep_cache = None
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def disable_folded_frame_layout(self):
+        self.folded_frame_layout = False
+        self._deep_cache = None
+        self.to(memory_format=torch.contiguous_format)
+
+    def enable_deep_cache(self, depth: int = 1):
+        r"""
+        Enables DeepCache style feature caching (https://arxiv.org/abs/2312.00858). Every full forward pass stores the
+        input of the last `depth` up blocks. A forward pass with `use_deep_cache=True` then only runs `conv_in`, the
+        first `depth` down blocks and the last `depth` up blocks, and reuses the stored features for everything
+        in between (including the temporal layers). A larger `depth` recomputes more blocks: slower, but closer to
+        the uncached output.
+        """
+        if not 1 <= depth < len(self.up_blocks):
+            raise ValueError(f"`depth` has to be between 1 and {len(self.up_blocks) - 1} but is {depth}")
+
+        self.deep_cache_depth = depth
+        self._deep_cache = None
+
+    def disable_deep_cache(self):
+        self.deep_cache_depth = None
+        self._deep_cache = None
+
+    def compile_for_inference(self,
+                              mode: Optional[str] = None,
+                              dynamic: bool = False,
+                              fullgraph: bool = False,
+                              max_shapes: int = 8):
+        r"""
+        Puts the model in eval mode and returns it wrapped in `torch.compile`, with einops traceable by TorchDynamo.
+
+        With `dynamic=False` every input shape (resolution bucket, number of frames, batch size) gets its own static
+        graph the first time it is seen. `max_shapes` raises TorchDynamo's recompilation limit so that many shapes
+        can be compiled before it falls back to eager mode. The returned module forwards attribute access to this
+        model, so it can replace `pipe.unet`.
+        """
+        import torch._dynamo
+
+        self.eval()
+        _allow_einops_in_compiled_graph()
+
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, max_shapes)
+
+        return torch.compile(self, mode=mode, dynamic=dynamic, fullgraph=fullgraph)
+
+    def graph_break_report(self, *args, **kwargs) -> Dict[str, Any]:
+        r"""
+        Traces a forward pass with the given arguments through TorchDynamo without compiling it, and returns the
+        number of graphs and graph breaks, together with the reason for every break.
+        """
+        import torch._dynamo
+
+        torch._dynamo.reset()
+        _allow_einops_in_compiled_graph()
+
+        if is_torch_version(">=", "2.1.0"):
+            explanation = torch._dynamo.explain(self)(*args, **kwargs)
+            graph_count, break_reasons = explanation.graph_count, explanation.break_reasons
+        else:
+            _, _, graphs, _, break_reasons, _ = torch._dynamo.explain(self, *args, **kwargs)
+            graph_count = len(graphs)
+
+        return {
+            "graph_count": graph_count,
+            "graph_break_count": len(break_reasons),
+            "break_reasons": [str(reason.reason) for reason in break_reasons],
+        }
+
     def temporal_parameters(self) -> list:
         output = []
         all_blocks = self.down_blocks + self.up_blocks + [self.mid_block]
@@ -644,7 +749,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             mid_block_additional_residual: Optional[torch.Tensor] = None,
             encoder_attention_mask: Optional[torch.Tensor] = None,
             return_dict: bool = True,
-            enable_temporal_attentions: bool = True
+            enable_temporal_attentions: bool = True,
+            use_deep_cache: bool = False,
     ) -> Union[UNet3DConditionOutput, Tuple]:
         r"""
         The [`UNet2DConditionModel`] forward method.
@@ -667,6 +773,9 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             added_cond_kwargs: (`dict`, *optional*):
                 A kwargs dictionary containin additional embeddings that if specified are added to the embeddings that
                 are passed along to the UNet blocks.
+            use_deep_cache (`bool`, *optional*, defaults to `False`):
+                Reuse the deep features stored by the last full forward pass, see `enable_deep_cache`. Falls back to
+                a full forward pass when the cache is disabled, empty or was stored for a sample of another shape.
 
         Returns:
             [`~models.unet_2d_condition.UNet2DConditionOutput`] or `tuple`:
@@ -831,25 +940,76 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             encoder_hidden_states = self.encoder_hid_proj(image_embeds)
         # 2. pre-process
 
+        # the deep features can only be reused for samples of the same shape
+        deep_cache_key = (tuple(sample.shape), enable_temporal_attentions, self.folded_frame_layout)
+        reuse_deep_cache = (
+            use_deep_cache
+            and self.deep_cache_depth is not None
+            and self._deep_cache is not None
+            and self._deep_cache[0] == deep_cache_key
+        )
+        deep_cache_up_block = len(self.up_blocks) - self.deep_cache_depth if self.deep_cache_depth else None
+
+        # a single frame without temporal layers is an image, run it through the spatial layers as a plain 4D
+        # tensor so none of the 3D layers have to reshape it
+        is_image = sample.ndim == 5 and sample.shape[2] == 1 and not enable_temporal_attentions
+
+        # the number of frames folded into the batch dimension, see `enable_folded_frame_layout`
+        num_frames = None
+
+        if is_image:
+            sample = sample[:, :, 0]
+
+            if down_block_additional_residuals is not None:
+                down_block_additional_residuals = [
+                    residual[:, :, 0] if residual.ndim == 5 else residual for residual in down_block_additional_residuals
+                ]
+
+            if mid_block_additional_residual is not None and mid_block_additional_residual.ndim == 5:
+                mid_block_additional_residual = mid_block_additional_residual[:, :, 0]
+        elif sample.ndim == 5:
+            # every frame attends to the same text embeddings. expand them to all frames once here, instead of
+            # in each of the spatial transformers
+            if encoder_hidden_states is not None:
+                encoder_hidden_states = encoder_hidden_states.repeat_interleave(sample.shape[2], dim=0)
+
+            if self.folded_frame_layout:
+                num_frames = sample.shape[2]
+                sample = rearrange(sample, "b c f h w -> (b f) c h w")
+                emb = emb.repeat_interleave(num_frames, dim=0)
+
+                if down_block_additional_residuals is not None:
+                    down_block_additional_residuals = [
+                        rearrange(residual, "b c f h w -> (b f) c h w") if residual.ndim == 5 else residual
+                        for residual in down_block_additional_residuals
+                    ]
+
+                if mid_block_additional_residual is not None and mid_block_additional_residual.ndim == 5:
+                    mid_block_additional_residual = rearrange(mid_block_additional_residual,
+                                                              "b c f h w -> (b f) c h w")
+
         sample = self.conv_in(sample)
 
         # 3. down
         down_block_res_samples = (sample,)
-        for downsample_block in self.down_blocks:
-            if hasattr(downsample_block, "has_cross_attention") and downsample_block.has_cross_attention:
+        down_blocks = self.down_blocks[:self.deep_cache_depth] if reuse_deep_cache else self.down_blocks
+        for downsample_block, has_cross_attention in zip(down_blocks, self._down_blocks_cross_attention):
+            if has_cross_attention:
                 sample, res_samples = downsample_block(
                     hidden_states=sample,
                     temb=emb,
                     encoder_hidden_states=encoder_hidden_states,
                     attention_mask=attention_mask,
                     cross_attention_kwargs=cross_attention_kwargs,
-                    enable_temporal_attentions=enable_temporal_attentions
+                    enable_temporal_attentions=enable_temporal_attentions,
+                    num_frames=num_frames
                 )
             else:
                 sample, res_samples = downsample_block(hidden_states=sample,
                                                        temb=emb,
                                                        encoder_hidden_states=encoder_hidden_states,
-                                                       enable_temporal_attentions=enable_temporal_attentions)
+                                                       enable_temporal_attentions=enable_temporal_attentions,
+                                                       num_frames=num_frames)
 
             down_block_res_samples += res_samples
 
@@ -864,22 +1024,35 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
 
             down_block_res_samples = new_down_block_res_samples
 
+        if reuse_deep_cache:
+            # only the last up blocks run, and they only need the skip connections of the first down blocks
+            sample = self._deep_cache[1]
+            num_res_samples = sum(len(block.resnets) for block in self.up_blocks[deep_cache_up_block:])
+            down_block_res_samples = down_block_res_samples[:num_res_samples]
+
         # 4. mid
-        if self.mid_block is not None:
+        if self.mid_block is not None and not reuse_deep_cache:
             sample = self.mid_block(
                 sample,
                 emb,
                 encoder_hidden_states=encoder_hidden_states,
                 attention_mask=attention_mask,
                 cross_attention_kwargs=cross_attention_kwargs,
-                enable_temporal_attentions=enable_temporal_attentions
+                enable_temporal_attentions=enable_temporal_attentions,
+                num_frames=num_frames
             )
 
-        if mid_block_additional_residual is not None:
+        if mid_block_additional_residual is not None and not reuse_deep_cache:
             sample = sample + mid_block_additional_residual
 
         # 5. up
         for i, upsample_block in enumerate(self.up_blocks):
+            if reuse_deep_cache and i < deep_cache_up_block:
+                continue
+
+            if i == deep_cache_up_block and not reuse_deep_cache:
+                self._deep_cache = (deep_cache_key, sample)
+
             is_final_block = i == len(self.up_blocks) - 1
 
             res_samples = down_block_res_samples[-len(upsample_block.resnets):]
@@ -888,9 +1061,9 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             # if we have not reached the final block and need to forward the
             # upsample size, we do it here
             if not is_final_block and forward_upsample_size:
-                upsample_size = down_block_res_samples[-1].shape[2:]
+                upsample_size = down_block_res_samples[-1].shape[-2:]
 
-            if hasattr(upsample_block, "has_cross_attention") and upsample_block.has_cross_attention:
+            if self._up_blocks_cross_attention[i]:
                 sample = upsample_block(
                     hidden_states=sample,
                     temb=emb,
@@ -899,7 +1072,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                     cross_attention_kwargs=cross_attention_kwargs,
                     upsample_size=upsample_size,
                     attention_mask=attention_mask,
-                    enable_temporal_attentions=enable_temporal_attentions
+                    enable_temporal_attentions=enable_temporal_attentions,
+                    num_frames=num_frames
                 )
             else:
                 sample = upsample_block(
@@ -908,16 +1082,22 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                     res_hidden_states_tuple=res_samples,
                     upsample_size=upsample_size,
                     encoder_hidden_states=encoder_hidden_states,
-                    enable_temporal_attentions=enable_temporal_attentions
+                    enable_temporal_attentions=enable_temporal_attentions,
+                    num_frames=num_frames
                 )
 
         # 6. post-process
         if self.conv_norm_out:
-            sample = self.conv_norm_out(sample)
+            sample = group_norm_frames(self.conv_norm_out, sample, num_frames)
             sample = self.conv_act(sample)
 
         sample = self.conv_out(sample)
 
+        if is_image:
+            sample = sample[:, :, None]
+        elif num_frames is not None:
+            sample = rearrange(sample, "(b f) c h w -> b c f h w", f=num_frames)
+
         if not return_dict:
             return (sample,)
 
@@ -16,6 +16,8 @@
 # Copyright 2023 Natural Synthetics Inc. All rights reserved.
 # - Add temporal transformers to unet blocks
 
+from typing import Optional
+
 import torch
 from torch import nn
 
@@ -230,11 +232,12 @@ class UNetMidBlock3DCrossAttn(nn.Module):
         self.resnets = nn.ModuleList(resnets)
 
     def forward(self, hidden_states, temb=None, encoder_hidden_states=None, attention_mask=None,
-                cross_attention_kwargs=None, enable_temporal_attentions: bool = True):
-        hidden_states = self.resnets[0](hidden_states, temb)
+                cross_attention_kwargs=None, enable_temporal_attentions: bool = True,
+                num_frames: Optional[int] = None):
+        hidden_states = self.resnets[0](hidden_states, temb, num_frames=num_frames)
         for attn, resnet in zip(self.attentions, self.resnets[1:]):
             hidden_states = attn(hidden_states, encoder_hidden_states=encoder_hidden_states).sample
-            hidden_states = resnet(hidden_states, temb)
+            hidden_states = resnet(hidden_states, temb, num_frames=num_frames)
 
         return hidden_states
 
@@ -332,7 +335,8 @@ class CrossAttnDownBlock3D(nn.Module):
         self.gradient_checkpointing = False
 
     def forward(self, hidden_states, temb=None, encoder_hidden_states=None, attention_mask=None,
-                cross_attention_kwargs=None, enable_temporal_attentions: bool = True):
+                cross_attention_kwargs=None, enable_temporal_attentions: bool = True,
+                num_frames: Optional[int] = None):
         output_states = ()
 
         for resnet, attn, temporal_attention \
@@ -349,6 +353,7 @@ class CrossAttnDownBlock3D(nn.Module):
                     return custom_forward
 
                 hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(resnet), hidden_states, temb,
+                                                                  num_frames,
                                                                   use_reentrant=False)
 
                 hidden_states = torch.utils.checkpoint.checkpoint(
@@ -360,16 +365,18 @@ class CrossAttnDownBlock3D(nn.Module):
                 if enable_temporal_attentions and temporal_attention is not None:
                     hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(temporal_attention),
                                                                       hidden_states, encoder_hidden_states,
+                                                                      num_frames,
                                                                       use_reentrant=False)
 
             else:
-                hidden_states = resnet(hidden_states, temb)
+                hidden_states = resnet(hidden_states, temb, num_frames=num_frames)
 
                 hidden_states = attn(hidden_states, encoder_hidden_states=encoder_hidden_states).sample
 
                 if temporal_attention and enable_temporal_attentions:
                     hidden_states = temporal_attention(hidden_states,
-                                                       encoder_hidden_states=encoder_hidden_states)
+                                                       encoder_hidden_states=encoder_hidden_states,
+                                                       num_frames=num_frames)
 
             output_states += (hidden_states,)
 
@@ -451,7 +458,8 @@ class DownBlock3D(nn.Module):
 
         self.gradient_checkpointing = False
 
-    def forward(self, hidden_states, temb=None, encoder_hidden_states=None, enable_temporal_attentions: bool = True):
+    def forward(self, hidden_states, temb=None, encoder_hidden_states=None, enable_temporal_attentions: bool = True,
+                num_frames: Optional[int] = None):
         output_states = ()
 
         for resnet, temporal_attention in zip(self.resnets, self.temporal_attentions):
@@ -463,16 +471,19 @@ class DownBlock3D(nn.Module):
                     return custom_forward
 
                 hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(resnet), hidden_states, temb,
+                                                                  num_frames,
                                                                   use_reentrant=False)
                 if enable_temporal_attentions and temporal_attention is not None:
                     hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(temporal_attention),
                                                                       hidden_states, encoder_hidden_states,
+                                                                      num_frames,
                                                                       use_reentrant=False)
             else:
-                hidden_states = resnet(hidden_states, temb)
+                hidden_states = resnet(hidden_states, temb, num_frames=num_frames)
 
                 if enable_temporal_attentions and temporal_attention:
-                    hidden_states = temporal_attention(hidden_states, encoder_hidden_states=encoder_hidden_states)
+                    hidden_states = temporal_attention(hidden_states, encoder_hidden_states=encoder_hidden_states,
+                                                       num_frames=num_frames)
 
             output_states += (hidden_states,)
 
@@ -586,7 +597,8 @@ class CrossAttnUpBlock3D(nn.Module):
             upsample_size=None,
             cross_attention_kwargs=None,
             attention_mask=None,
-            enable_temporal_attentions: bool = True
+            enable_temporal_attentions: bool = True,
+            num_frames: Optional[int] = None
     ):
         for resnet, attn, temporal_attention \
                 in zip(self.resnets, self.attentions, self.temporal_attentions):
@@ -607,6 +619,7 @@ class CrossAttnUpBlock3D(nn.Module):
                     return custom_forward
 
                 hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(resnet), hidden_states, temb,
+                                                                  num_frames,
                                                                   use_reentrant=False)
 
                 hidden_states = torch.utils.checkpoint.checkpoint(
@@ -618,15 +631,17 @@ class CrossAttnUpBlock3D(nn.Module):
                 if enable_temporal_attentions and temporal_attention is not None:
                     hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(temporal_attention),
                                                                       hidden_states, encoder_hidden_states,
+                                                                      num_frames,
                                                                       use_reentrant=False)
 
             else:
-                hidden_states = resnet(hidden_states, temb)
+                hidden_states = resnet(hidden_states, temb, num_frames=num_frames)
                 hidden_states = attn(hidden_states, encoder_hidden_states=encoder_hidden_states).sample
 
                 if enable_temporal_attentions and temporal_attention:
                     hidden_states = temporal_attention(hidden_states,
-                                                       encoder_hidden_states=encoder_hidden_states)
+                                                       encoder_hidden_states=encoder_hidden_states,
+                                                       num_frames=num_frames)
 
         if self.upsamplers is not None:
             for upsampler in self.upsamplers:
@@ -701,7 +716,7 @@ class UpBlock3D(nn.Module):
         self.gradient_checkpointing = False
 
     def forward(self, hidden_states, res_hidden_states_tuple, temb=None, upsample_size=None, encoder_hidden_states=None,
-                enable_temporal_attentions: bool = True):
+                enable_temporal_attentions: bool = True, num_frames: Optional[int] = None):
         for resnet, temporal_attention in zip(self.resnets, self.temporal_attentions):
             # pop res hidden states
             res_hidden_states = res_hidden_states_tuple[-1]
@@ -716,15 +731,18 @@ class UpBlock3D(nn.Module):
                     return custom_forward
 
                 hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(resnet), hidden_states, temb,
+                                                                  num_frames,
                                                                   use_reentrant=False)
                 if enable_temporal_attentions and temporal_attention is not None:
                     hidden_states = torch.utils.checkpoint.checkpoint(create_custom_forward(temporal_attention),
                                                                       hidden_states, encoder_hidden_states,
+                                                                      num_frames,
                                                                       use_reentrant=False)
             else:
-                hidden_states = resnet(hidden_states, temb)
+                hidden_states = resnet(hidden_states, temb, num_frames=num_frames)
                 hidden_states = temporal_attention(hidden_states,
-                                                   encoder_hidden_states=encoder_hidden_states) if enable_temporal_attentions and temporal_attention is not None else hidden_states
+                                                   encoder_hidden_states=encoder_hidden_states,
+                                                   num_frames=num_frames) if enable_temporal_attentions and temporal_attention is not None else hidden_states
 
         if self.upsamplers is not None:
             for upsampler in self.upsamplers:
@@ -27,6 +27,8 @@ import torch.nn.functional as F
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
 
 from hotshot_xl import HotshotPipelineXLOutput
+from hotshot_xl.pipelines.offload import ModelOffloader
+from hotshot_xl.pipelines.prompt_cache import PromptEmbeddingCache, mark_text_encoder_lora_changed
 
 from diffusers.image_processor import VaeImageProcessor
 from diffusers.loaders import FromSingleFileMixin, LoraLoaderMixin, TextualInversionLoaderMixin
@@ -183,6 +185,10 @@ class HotshotXLControlNetPipeline(
         )
 
         self.watermark = None
+        self.prompt_embedding_cache = None
+        self.low_vram_mode = False
+        self.offload_reserve_bytes = None
+        self.offloader = None
 
         self.register_to_config(force_zeros_for_empty_prompt=force_zeros_for_empty_prompt)
 
@@ -251,7 +257,7 @@ class HotshotXLControlNetPipeline(
         # We'll offload the last model manually.
         self.final_offload_hook = hook
 
-    # Copied from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl.StableDiffusionXLPipeline.encode_prompt
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.encode_prompt
     def encode_prompt(
         self,
         prompt: str,
@@ -355,14 +361,8 @@ class HotshotXLControlNetPipeline(
                         f" {tokenizer.model_max_length} tokens: {removed_text}"
                     )
 
-                prompt_embeds = text_encoder(
-                    text_input_ids.to(device),
-                    output_hidden_states=True,
-                )
-
                 # We are only ALWAYS interested in the pooled output of the final text encoder
-                pooled_prompt_embeds = prompt_embeds[0]
-                prompt_embeds = prompt_embeds.hidden_states[-2]
+                pooled_prompt_embeds, prompt_embeds = self._encode_text(text_encoder, text_input_ids, device)
 
                 prompt_embeds_list.append(prompt_embeds)
 
@@ -408,13 +408,10 @@ class HotshotXLControlNetPipeline(
                     return_tensors="pt",
                 )
 
-                negative_prompt_embeds = text_encoder(
-                    uncond_input.input_ids.to(device),
-                    output_hidden_states=True,
-                )
                 # We are only ALWAYS interested in the pooled output of the final text encoder
-                negative_pooled_prompt_embeds = negative_prompt_embeds[0]
-                negative_prompt_embeds = negative_prompt_embeds.hidden_states[-2]
+                negative_pooled_prompt_embeds, negative_prompt_embeds = self._encode_text(
+                    text_encoder, uncond_input.input_ids, device
+                )
 
                 negative_prompt_embeds_list.append(negative_prompt_embeds)
 
@@ -443,6 +440,49 @@ class HotshotXLControlNetPipeline(
 
         return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
 
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.enable_prompt_embedding_cache
+    def enable_prompt_embedding_cache(self, cache: Optional[PromptEmbeddingCache] = None, max_entries: int = 64):
+        r"""
+        Caches the text encoder outputs of prompts and negative prompts, so repeated prompts (e.g. the same negative
+        prompt for every request, or a re-roll with a new seed) skip text encoding. Pass the same `cache` to several
+        pipelines to share the cached embeddings between them.
+        """
+        self.prompt_embedding_cache = cache if cache is not None else PromptEmbeddingCache(max_entries=max_entries)
+
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.disable_prompt_embedding_cache
+    def disable_prompt_embedding_cache(self):
+        r"""
+        Disable the prompt embedding cache enabled with `enable_prompt_embedding_cache`.
+        """
+        self.prompt_embedding_cache = None
+
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.get_offloader
+    def get_offloader(self, device: Optional[torch.device] = None) -> ModelOffloader:
+        r"""
+        Returns the [`ModelOffloader`] that moves every component but the unet between `device` (the device of the
+        unet by default) and the CPU in low VRAM mode, creating it on first use. Components stay resident across
+        calls as long as `offload_reserve_bytes` of device memory stay free, see [`ModelOffloader`].
+        """
+        device = ModelOffloader.normalize_device(device or self.unet.device)
+
+        if self.offloader is None or self.offloader.device != device:
+            self.offloader = ModelOffloader(device)
+            for name, component in self.components.items():
+                if isinstance(component, torch.nn.Module) and name != "unet":
+                    self.offloader.register(name, component)
+
+        self.offloader.reserve_bytes = self.offload_reserve_bytes
+        return self.offloader
+
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline._encode_text
+    def _encode_text(self, text_encoder, input_ids, device):
+        # returns the pooled output and the penultimate hidden states of the text encoder
+        if self.prompt_embedding_cache is not None:
+            return self.prompt_embedding_cache.encode(text_encoder, input_ids, device, lora_scale=self.lora_scale)
+
+        output = text_encoder(input_ids.to(device), output_hidden_states=True)
+        return output[0], output.hidden_states[-2]
+
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.prepare_extra_step_kwargs
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -561,23 +601,19 @@ class HotshotXLControlNetPipeline(
             or is_compiled
             and isinstance(self.controlnet._orig_mod, MultiControlNetModel)
         ):
-            ...
-            # todo
-            #
-            # if not isinstance(image, list):
-            #     raise TypeError("For multiple controlnets: `image` must be type `list`")
-            #
-            # # When `image` is a nested list:
-            # # (e.g. [[canny_image_1, pose_image_1], [canny_image_2, pose_image_2]])
-            # elif any(isinstance(i, list) for i in image):
-            #     raise ValueError("A single batch of multiple conditionings are supported at the moment.")
-            # elif len(image) != len(self.controlnet.nets):
-            #     raise ValueError(
-            #         f"For multiple controlnets: `image` must have the same length as the number of controlnets, but got {len(image)} images and {len(self.controlnet.nets)} ControlNets."
-            #     )
-            #
-            # for image_ in image:
-            #     self.check_image(image_, prompt, prompt_embeds)
+            nets = self.controlnet._orig_mod.nets if is_compiled else self.controlnet.nets
+
+            # one list of frames for every controlnet
+            # (e.g. [[depth_frame_1, depth_frame_2, ...], [canny_frame_1, canny_frame_2, ...]])
+            if not isinstance(control_images, list) or not all(isinstance(i, list) for i in control_images):
+                raise TypeError("For multiple controlnets: `control_images` must be a list of lists of frames.")
+            elif len(control_images) != len(nets):
+                raise ValueError(
+                    f"For multiple controlnets: `control_images` must have the same length as the number of controlnets, but got {len(control_images)} lists of frames and {len(nets)} ControlNets."
+                )
+
+            for control_images_ in control_images:
+                assert len(control_images_) == video_length
         else:
             assert False
 
@@ -594,16 +630,16 @@ class HotshotXLControlNetPipeline(
             or is_compiled
             and isinstance(self.controlnet._orig_mod, MultiControlNetModel)
         ):
+            nets = self.controlnet._orig_mod.nets if is_compiled else self.controlnet.nets
+
             if isinstance(controlnet_conditioning_scale, list):
                 if any(isinstance(i, list) for i in controlnet_conditioning_scale):
                     raise ValueError("A single batch of multiple conditionings are supported at the moment.")
-            elif isinstance(controlnet_conditioning_scale, list) and len(controlnet_conditioning_scale) != len(
-                self.controlnet.nets
-            ):
-                raise ValueError(
-                    "For multiple controlnets: When `controlnet_conditioning_scale` is specified as `list`, it must have"
-                    " the same length as the number of controlnets"
-                )
+                elif len(controlnet_conditioning_scale) != len(nets):
+                    raise ValueError(
+                        "For multiple controlnets: When `controlnet_conditioning_scale` is specified as `list`, it must have"
+                        " the same length as the number of controlnets"
+                    )
         else:
             assert False
 
@@ -672,7 +708,7 @@ class HotshotXLControlNetPipeline(
                 f"If image batch size is not 1, image batch size must be same as prompt batch size. image batch size: {image_batch_size}, prompt batch size: {prompt_batch_size}"
             )
 
-    # Copied from diffusers.pipelines.controlnet.pipeline_controlnet.StableDiffusionControlNetPipeline.prepare_image
+    # Adapted from diffusers.pipelines.controlnet.pipeline_controlnet.StableDiffusionControlNetPipeline.prepare_image
     def prepare_images(
         self,
         images,
@@ -685,34 +721,35 @@ class HotshotXLControlNetPipeline(
         do_classifier_free_guidance=False,
         guess_mode=False,
     ):
-        images_pre_processed = [self.control_image_processor.preprocess(image, height=height, width=width).to(dtype=torch.float32) for image in images]
-
-        images_pre_processed = torch.cat(images_pre_processed, dim=0)
-
-        repeat_factor = [1] * len(images_pre_processed.shape)
-        repeat_factor[0] = batch_size * num_images_per_prompt
-        images_pre_processed = images_pre_processed.repeat(*repeat_factor)
+        if all(isinstance(image, PIL.Image.Image) for image in images):
+            # all frames are converted to a single uint8 array, uploaded at once and converted on the device
+            height, width = self.control_image_processor.get_default_height_width(images[0], height, width)
+            frames = np.stack([np.asarray(self._prepare_control_frame(image, height, width)) for image in images])
+            images = torch.from_numpy(frames).to(device=device)
+            images = images.permute(0, 3, 1, 2).to(dtype=torch.float32).div_(255).to(dtype=dtype)
+        else:
+            images = self.control_image_processor.preprocess(images, height=height, width=width)
+            images = images.to(device=device, dtype=dtype)
 
-        images = images_pre_processed.unsqueeze(0)
+        # the frames are repeated for every video of the batch and for the unconditional batch of classifier free
+        # guidance with expanded views instead of copies. For a single video, the frames are only materialized
+        # once, when they are flattened into the controlnet input.
+        images = images.unsqueeze(0).expand(batch_size * num_images_per_prompt, *images.shape)
+        images = images.reshape(1, -1, *images.shape[-3:])
 
-        # image_batch_size = image.shape[0]
-        #
-        # if image_batch_size == 1:
-        #     repeat_by = batch_size
-        # else:
-        #     # image batch size is the same as prompt batch size
-        #     repeat_by = num_images_per_prompt
+        if do_classifier_free_guidance and not guess_mode:
+            images = images.expand(2, *images.shape[1:])
 
-        #image = image.repeat_interleave(repeat_by, dim=0)
+        return images
 
-        images = images.to(device=device, dtype=dtype)
+    def _prepare_control_frame(self, image: PIL.Image.Image, height: int, width: int) -> PIL.Image.Image:
+        if self.control_image_processor.config.do_convert_rgb and image.mode != "RGB":
+            image = image.convert("RGB")
 
-        if do_classifier_free_guidance and not guess_mode:
-            repeat_factor = [1] * len(images.shape)
-            repeat_factor[0] = 2
-            images = images.repeat(*repeat_factor)
+        if image.size != (width, height):
+            image = self.control_image_processor.resize(image, height, width)
 
-        return images
+        return image
 
     # def prepare_images(self,
     #     images: list,
@@ -744,6 +781,66 @@ class HotshotXLControlNetPipeline(
     #
     #     return image
 
+    def run_controlnets(
+        self,
+        sample,
+        timestep,
+        encoder_hidden_states,
+        controlnet_cond,
+        conditioning_scale,
+        guess_mode=False,
+        added_cond_kwargs=None,
+    ):
+        r"""
+        Runs the controlnet, or every controlnet of a [`MultiControlNetModel`], on `sample` and returns the summed
+        `(down_block_res_samples, mid_block_res_sample)`.
+
+        All controlnets share the same `sample`, `encoder_hidden_states` and `added_cond_kwargs`, only
+        `controlnet_cond` and `conditioning_scale` are given per controlnet. Controlnets whose conditioning scale is 0
+        (e.g. because the step is outside of their `control_guidance_start` / `control_guidance_end` window) aren't
+        run at all.
+        """
+        controlnet = self.controlnet._orig_mod if is_compiled_module(self.controlnet) else self.controlnet
+
+        if not isinstance(controlnet, MultiControlNetModel):
+            return self.controlnet(
+                sample,
+                timestep,
+                encoder_hidden_states=encoder_hidden_states,
+                controlnet_cond=controlnet_cond,
+                conditioning_scale=conditioning_scale,
+                guess_mode=guess_mode,
+                added_cond_kwargs=added_cond_kwargs,
+                return_dict=False,
+            )
+
+        down_block_res_samples, mid_block_res_sample = None, None
+
+        for image, scale, net in zip(controlnet_cond, conditioning_scale, controlnet.nets):
+            if scale == 0:
+                continue
+
+            down_samples, mid_sample = net(
+                sample,
+                timestep,
+                encoder_hidden_states=encoder_hidden_states,
+                controlnet_cond=image,
+                conditioning_scale=scale,
+                guess_mode=guess_mode,
+                added_cond_kwargs=added_cond_kwargs,
+                return_dict=False,
+            )
+
+            # merge samples
+            if down_block_res_samples is None:
+                down_block_res_samples, mid_block_res_sample = list(down_samples), mid_sample
+            else:
+                for samples_prev, samples_curr in zip(down_block_res_samples, down_samples):
+                    samples_prev += samples_curr
+                mid_block_res_sample += mid_sample
+
+        return down_block_res_samples, mid_block_res_sample
+
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.prepare_latents
     def prepare_latents(self, batch_size, num_channels_latents, video_length, height, width, dtype, device, generator, latents=None):
         #shape = (batch_size, num_channels_latents, height // self.vae_scale_factor, width // self.vae_scale_factor)
@@ -838,6 +935,10 @@ class HotshotXLControlNetPipeline(
         negative_original_size: Optional[Tuple[int, int]] = None,
         negative_crops_coords_top_left: Tuple[int, int] = (0, 0),
         negative_target_size: Optional[Tuple[int, int]] = None,
+        decode_chunk_size: Union[int, str] = 1,
+        low_vram_mode: bool = False,
+        offload_reserve_bytes: Optional[int] = None,
+        controlnet_cache_steps: int = 1,
     ):
         r"""
         The call function to the pipeline for generation.
@@ -856,6 +957,9 @@ class HotshotXLControlNetPipeline(
                 and/or width are passed, `image` is resized accordingly. If multiple ControlNets are specified in
                 `init`, images must be passed as a list such that each element of the list can be correctly batched for
                 input to a single ControlNet.
+            control_images (`List[PIL.Image.Image]` or `List[List[PIL.Image.Image]]`):
+                The frames conditioning the ControlNet, one per frame of the video. With multiple ControlNets, a list
+                with the frames for every ControlNet, in the same order as the ControlNets.
             height (`int`, *optional*, defaults to `self.unet.config.sample_size * self.vae_scale_factor`):
                 The height in pixels of the generated image.
             width (`int`, *optional*, defaults to `self.unet.config.sample_size * self.vae_scale_factor`):
@@ -898,7 +1002,9 @@ class HotshotXLControlNetPipeline(
                 weighting). If not provided, pooled `negative_prompt_embeds` are generated from `negative_prompt` input
                 argument.
             output_type (`str`, *optional*, defaults to `"pil"`):
-                The output format of the generated image. Choose between `PIL.Image` or `np.array`.
+                The output format of the generated video. Choose between `"tensor"`, `np.array`, `"uint8"` for a
+                uint8 numpy array of shape (b, f, h, w, c), or `"latent"` to skip decoding and return the latents as
+                a tensor of shape (b, c, f, h, w).
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
                 plain tuple.
@@ -914,7 +1020,7 @@ class HotshotXLControlNetPipeline(
             controlnet_conditioning_scale (`float` or `List[float]`, *optional*, defaults to 1.0):
                 The outputs of the ControlNet are multiplied by `controlnet_conditioning_scale` before they are added
                 to the residual in the original `unet`. If multiple ControlNets are specified in `init`, you can set
-                the corresponding scale as a list.
+                the corresponding scale as a list. A ControlNet whose scale is 0 at a step isn't run in that step.
             guess_mode (`bool`, *optional*, defaults to `False`):
                 The ControlNet encoder tries to recognize the content of the input image even if you remove all
                 prompts. A `guidance_scale` value between 3.0 and 5.0 is recommended.
@@ -951,6 +1057,21 @@ class HotshotXLControlNetPipeline(
                 as the `target_size` for most cases. Part of SDXL's micro-conditioning as explained in section 2.2 of
                 [https://huggingface.co/papers/2307.01952](https://huggingface.co/papers/2307.01952). For more
                 information, refer to this issue thread: https://github.com/huggingface/diffusers/issues/4208.
+            decode_chunk_size (`int` or `str`, *optional*, defaults to 1):
+                The number of frames decoded by the VAE at once. Higher values decode faster but need more memory.
+                Pass `"auto"` to pick the largest chunk size that fits into the free CUDA memory.
+            low_vram_mode (`bool`, *optional*, defaults to `False`):
+                Keep only the components needed for the current stage (text encoding, denoising, decoding) on the
+                device, see [`get_offloader`].
+            offload_reserve_bytes (`int`, *optional*):
+                In low VRAM mode, only offload components until this many bytes of device memory are free, so
+                components that fit stay on the device across calls. By default every component not needed for the
+                current stage is offloaded.
+            controlnet_cache_steps (`int`, *optional*, defaults to 1):
+                Only run the ControlNet every `controlnet_cache_steps` steps and reuse its last residuals in the steps
+                in between. Steps in which the ControlNet doesn't apply (its conditioning scale is 0, see
+                `control_guidance_start` and `control_guidance_end`) skip it in any case, and the residuals are
+                recomputed whenever the conditioning scale of any ControlNet changes.
 
         Examples:
 
@@ -961,6 +1082,12 @@ class HotshotXLControlNetPipeline(
         """
 
 
+        self.low_vram_mode = low_vram_mode
+        self.offload_reserve_bytes = offload_reserve_bytes
+
+        if controlnet_cache_steps < 1:
+            raise ValueError(f"`controlnet_cache_steps` has to be at least 1 but is {controlnet_cache_steps}.")
+
         if video_length > 1 and num_images_per_prompt > 1:
             print(f"Warning - setting num_images_per_prompt = 1 because video_length = {video_length}")
             num_images_per_prompt = 1
@@ -1004,7 +1131,8 @@ class HotshotXLControlNetPipeline(
         else:
             batch_size = prompt_embeds.shape[0]
 
-        device = self._execution_device
+        # in low VRAM mode the other components may still be offloaded, but the unet always stays on the device
+        device = self.unet.device if self.low_vram_mode else self._execution_device
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
         # corresponds to doing no classifier free guidance.
@@ -1020,6 +1148,9 @@ class HotshotXLControlNetPipeline(
         )
         guess_mode = guess_mode or global_pool_conditions
 
+        if self.low_vram_mode:
+            self.get_offloader(device).require("text_encoder", "text_encoder_2")
+
         # 3. Encode input prompt
         text_encoder_lora_scale = (
             cross_attention_kwargs.get("scale", None) if cross_attention_kwargs is not None else None
@@ -1044,6 +1175,9 @@ class HotshotXLControlNetPipeline(
             lora_scale=text_encoder_lora_scale,
         )
 
+        if self.low_vram_mode:
+            # only the unet and the controlnet are needed while denoising
+            self.get_offloader(device).require("controlnet")
 
         # 4. Prepare image
         if isinstance(controlnet, ControlNetModel):
@@ -1065,27 +1199,26 @@ class HotshotXLControlNetPipeline(
             height, width = images.shape[-2:]
         elif isinstance(controlnet, MultiControlNetModel):
 
-            raise Exception("not supported yet")
-
-            # images = []
-            #
-            # for image_ in control_images:
-            #     image_ = self.prepare_image(
-            #         image=image_,
-            #         width=width,
-            #         height=height,
-            #         batch_size=batch_size * num_images_per_prompt,
-            #         num_images_per_prompt=num_images_per_prompt,
-            #         device=device,
-            #         dtype=controlnet.dtype,
-            #         do_classifier_free_guidance=do_classifier_free_guidance,
-            #         guess_mode=guess_mode,
-            #     )
-            #
-            #     images.append(image_)
-            #
-            # image = images
-            # height, width = image[0].shape[-2:]
+            images = []
+
+            for control_images_ in control_images:
+                assert len(control_images_) == video_length * batch_size
+
+                images_ = self.prepare_images(
+                    images=control_images_,
+                    width=width,
+                    height=height,
+                    batch_size=batch_size * num_images_per_prompt,
+                    num_images_per_prompt=num_images_per_prompt,
+                    device=device,
+                    dtype=controlnet.dtype,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                    guess_mode=guess_mode,
+                )
+
+                images.append(images_)
+
+            height, width = images[0].shape[-2:]
         else:
             assert False
 
@@ -1120,10 +1253,10 @@ class HotshotXLControlNetPipeline(
             controlnet_keep.append(keeps[0] if isinstance(controlnet, ControlNetModel) else keeps)
 
         # 7.2 Prepare added time ids & embeddings
-        # if isinstance(image, list):
-        #     original_size = original_size or image[0].shape[-2:]
-        # else:
-        original_size = original_size or images.shape[-2:]
+        if isinstance(images, list):
+            original_size = original_size or images[0].shape[-2:]
+        else:
+            original_size = original_size or images.shape[-2:]
         target_size = target_size or (height, width)
 
         add_text_embeds = pooled_prompt_embeds
@@ -1153,80 +1286,113 @@ class HotshotXLControlNetPipeline(
         # 8. Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
 
-        images = rearrange(images, "b f c h w -> (b f) c h w")
+        if isinstance(images, list):
+            images = [rearrange(images_, "b f c h w -> (b f) c h w") for images_ in images]
+        else:
+            images = rearrange(images, "b f c h w -> (b f) c h w")
+
+        added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
+
+        # the controlnet conditioning doesn't change between steps, so it's prepared once here
+        if guess_mode and do_classifier_free_guidance:
+            # Infer ControlNet only for the conditional batch.
+            controlnet_prompt_embeds = prompt_embeds.chunk(2)[1]
+            controlnet_added_cond_kwargs = {
+                "text_embeds": add_text_embeds.chunk(2)[1],
+                "time_ids": add_time_ids.chunk(2)[1],
+            }
+        else:
+            controlnet_prompt_embeds = prompt_embeds
+            controlnet_added_cond_kwargs = added_cond_kwargs
+
+        # the controlnet runs on the frames as a batch of images, with the frames of a video next to each other
+        # (see the rearrange of `control_model_input` below)
+        if video_length > 1:
+            # use repeat_interleave as we need to match the rearrangement below.
+            controlnet_prompt_embeds = controlnet_prompt_embeds.repeat_interleave(video_length, dim=0)
+            controlnet_added_cond_kwargs = {
+                "text_embeds": controlnet_added_cond_kwargs['text_embeds'].repeat_interleave(video_length, dim=0),
+                "time_ids": controlnet_added_cond_kwargs['time_ids'].repeat_interleave(video_length, dim=0)
+            }
+
+        # the last residuals of the controlnet, reused for `controlnet_cache_steps` steps
+        controlnet_residuals = None
+
+        cond_scales = []
+        for keep in controlnet_keep:
+            if isinstance(keep, list):
+                cond_scales.append([c * s for c, s in zip(controlnet_conditioning_scale, keep)])
+            else:
+                controlnet_cond_scale = controlnet_conditioning_scale
+                if isinstance(controlnet_cond_scale, list):
+                    controlnet_cond_scale = controlnet_cond_scale[0]
+                cond_scales.append(controlnet_cond_scale * keep)
 
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
+                if self.low_vram_mode and i == len(timesteps) - 1:
+                    # copy the vae to the device while the last step is running
+                    self.get_offloader(device).prefetch("vae")
+
                 # expand the latents if we are doing classifier free guidance
                 latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
-                added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
-
-                # controlnet(s) inference
-                if guess_mode and do_classifier_free_guidance:
-                    # Infer ControlNet only for the conditional batch.
-                    control_model_input = latents
-                    control_model_input = self.scheduler.scale_model_input(control_model_input, t)
-                    controlnet_prompt_embeds = prompt_embeds.chunk(2)[1]
-                    controlnet_added_cond_kwargs = {
-                        "text_embeds": add_text_embeds.chunk(2)[1],
-                        "time_ids": add_time_ids.chunk(2)[1],
-                    }
-                else:
-                    control_model_input = latent_model_input
-                    controlnet_prompt_embeds = prompt_embeds
-                    controlnet_added_cond_kwargs = added_cond_kwargs
-
-                if isinstance(controlnet_keep[i], list):
-                    cond_scale = [c * s for c, s in zip(controlnet_conditioning_scale, controlnet_keep[i])]
-                else:
-                    controlnet_cond_scale = controlnet_conditioning_scale
-                    if isinstance(controlnet_cond_scale, list):
-                        controlnet_cond_scale = controlnet_cond_scale[0]
-                    cond_scale = controlnet_cond_scale * controlnet_keep[i]
-
-
-                # this will be non interlaced when arranged!
-                control_model_input = rearrange(control_model_input, "b c f h w -> (b f) c h w")
-                # if we chunked this by 2 - the top 8 frames will be positive for cfg
-                # the bottom half will be negative for cfg...
-
-                if video_length > 1:
-                    # use repeat_interleave as we need to match the rearrangement above.
-
-                    controlnet_prompt_embeds = controlnet_prompt_embeds.repeat_interleave(video_length, dim=0)
-                    controlnet_added_cond_kwargs = {
-                        "text_embeds": controlnet_added_cond_kwargs['text_embeds'].repeat_interleave(video_length, dim=0),
-                        "time_ids": controlnet_added_cond_kwargs['time_ids'].repeat_interleave(video_length, dim=0)
-                    }
-
-                # if type(image) is list:
-                #     image = torch.cat(image, dim=0)
-
-                # todo - check if video_length > 1 this needs to produce num_frames * batch_size samples...
-                down_block_res_samples, mid_block_res_sample = self.controlnet(
-                    control_model_input,
-                    t,
-                    encoder_hidden_states=controlnet_prompt_embeds,
-                    controlnet_cond=images,
-                    conditioning_scale=cond_scale,
-                    guess_mode=guess_mode,
-                    added_cond_kwargs=controlnet_added_cond_kwargs,
-                    return_dict=False,
-                )
+                cond_scale = cond_scales[i]
+                controlnet_applies = any(cond_scale) if isinstance(cond_scale, list) else cond_scale != 0
+
+                if not controlnet_applies:
+                    # the residuals would all be zero, skip the controlnet
+                    controlnet_residuals = None
+                elif (
+                    controlnet_residuals is None
+                    or i % controlnet_cache_steps == 0
+                    # the cached residuals are only valid for the scales they were computed with, recompute them
+                    # when the guidance window of a controlnet opens or closes
+                    or cond_scale != cond_scales[i - 1]
+                ):
+                    # controlnet(s) inference
+                    if guess_mode and do_classifier_free_guidance:
+                        # Infer ControlNet only for the conditional batch.
+                        control_model_input = latents
+                        control_model_input = self.scheduler.scale_model_input(control_model_input, t)
+                    else:
+                        control_model_input = latent_model_input
+
+                    # this will be non interlaced when arranged!
+                    control_model_input = rearrange(control_model_input, "b c f h w -> (b f) c h w")
+                    # if we chunked this by 2 - the top 8 frames will be positive for cfg
+                    # the bottom half will be negative for cfg...
+
+                    # if type(image) is list:
+                    #     image = torch.cat(image, dim=0)
+
+                    # todo - check if video_length > 1 this needs to produce num_frames * batch_size samples...
+                    down_block_res_samples, mid_block_res_sample = self.run_controlnets(
+                        control_model_input,
+                        t,
+                        encoder_hidden_states=controlnet_prompt_embeds,
+                        controlnet_cond=images,
+                        conditioning_scale=cond_scale,
+                        guess_mode=guess_mode,
+                        added_cond_kwargs=controlnet_added_cond_kwargs,
+                    )
 
-                for j, sample in enumerate(down_block_res_samples):
-                    down_block_res_samples[j] = rearrange(sample, "(b f) c h w -> b c f h w", f=video_length)
+                    for j, sample in enumerate(down_block_res_samples):
+                        down_block_res_samples[j] = rearrange(sample, "(b f) c h w -> b c f h w", f=video_length)
 
-                mid_block_res_sample = rearrange(mid_block_res_sample, "(b f) c h w -> b c f h w", f=video_length)
+                    mid_block_res_sample = rearrange(mid_block_res_sample, "(b f) c h w -> b c f h w", f=video_length)
 
-                if guess_mode and do_classifier_free_guidance:
-                    # Infered ControlNet only for the conditional batch.
-                    # To apply the output of ControlNet to both the unconditional and conditional batches,
-                    # add 0 to the unconditional batch to keep it unchanged.
-                    down_block_res_samples = [torch.cat([torch.zeros_like(d), d]) for d in down_block_res_samples]
-                    mid_block_res_sample = torch.cat([torch.zeros_like(mid_block_res_sample), mid_block_res_sample])
+                    if guess_mode and do_classifier_free_guidance:
+                        # Infered ControlNet only for the conditional batch.
+                        # To apply the output of ControlNet to both the unconditional and conditional batches,
+                        # add 0 to the unconditional batch to keep it unchanged.
+                        down_block_res_samples = [torch.cat([torch.zeros_like(d), d]) for d in down_block_res_samples]
+                        mid_block_res_sample = torch.cat([torch.zeros_like(mid_block_res_sample), mid_block_res_sample])
+
+                    controlnet_residuals = (down_block_res_samples, mid_block_res_sample)
+
+                down_block_res_samples, mid_block_res_sample = controlnet_residuals or (None, None)
 
                 # predict the noise residual
                 noise_pred = self.unet(
@@ -1259,6 +1425,10 @@ class HotshotXLControlNetPipeline(
                     if callback is not None and i % callback_steps == 0:
                         callback(i, t, latents)
 
+        if self.low_vram_mode:
+            # wait for the prefetch of the vae before the upcast below reads its weights
+            self.get_offloader(device).require("vae")
+
         # make sure the VAE is in float32 mode, as it overflows in float16
         if self.vae.dtype == torch.float16 and self.vae.config.force_upcast:
             self.upcast_vae()
@@ -1288,29 +1458,103 @@ class HotshotXLControlNetPipeline(
         #     image = latents
         #     return StableDiffusionXLPipelineOutput(images=image)
 
-        video = self.decode_latents(latents)
+        if output_type == "latent":
+            video = latents
+        elif output_type == "uint8":
+            video = np.concatenate(list(
+                self.iter_decode_latents(latents, decode_chunk_size=decode_chunk_size, output_type="uint8")
+            ))
+            video = video.reshape(latents.shape[0], latents.shape[2], *video.shape[1:])
+        else:
+            video = self.decode_latents(latents, decode_chunk_size=decode_chunk_size)
 
-        # Convert to tensor
-        if output_type == "tensor":
-            video = torch.from_numpy(video)
+            # Convert to tensor
+            if output_type == "tensor":
+                video = torch.from_numpy(video)
 
         if not return_dict:
             return video
 
         return HotshotPipelineXLOutput(videos=video)
 
-    def decode_latents(self, latents):
-        video_length = latents.shape[2]
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.stream
+    @torch.no_grad()
+    def stream(self, *args, decode_chunk_size: Union[int, str] = 1, output_type: str = "tensor", **kwargs):
+        r"""
+        Runs the pipeline like `__call__`, but yields the decoded frames chunk by chunk while the VAE is still
+        decoding the rest of the video, so they can be encoded or sent right away.
+
+        Takes the same arguments as `__call__` (`return_dict` is ignored). With `output_type="tensor"` every chunk
+        is a float32 CPU tensor of shape (n, c, h, w) with values in [0, 1], with `output_type="uint8"` it's a
+        contiguous uint8 numpy array of shape (n, h, w, c). Frames are yielded in order, one video after the other.
+        """
+        kwargs.update(output_type="latent", return_dict=False)
+        latents = self(*args, **kwargs)
+
+        for frames in self.iter_decode_latents(latents, decode_chunk_size=decode_chunk_size, output_type=output_type):
+            yield frames if output_type == "uint8" else frames.cpu().float()
+
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.get_decode_chunk_size
+    def get_decode_chunk_size(self, latents, decode_chunk_size: Union[int, str] = "auto") -> int:
+        r"""
+        Returns the number of frames to decode per VAE call for `latents` of shape (b, c, f, h, w).
+
+        With `decode_chunk_size="auto"` the chunk size is derived from the free CUDA memory, using a rough estimate
+        of the peak memory needed to decode a single frame. Off CUDA, frames are decoded one at a time.
+        """
+        num_frames = latents.shape[0] * latents.shape[2]
+
+        if decode_chunk_size != "auto":
+            return max(1, min(int(decode_chunk_size), num_frames))
+
+        device = self.vae.device
+        if device.type != "cuda":
+            return 1
+
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        # memory held by the caching allocator but not used by any tensor is free as well
+        free_memory += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+        height = latents.shape[-2] * self.vae_scale_factor
+        width = latents.shape[-1] * self.vae_scale_factor
+        element_size = torch.tensor([], dtype=self.vae.dtype).element_size()
+        # the full resolution decoder blocks dominate, count their activations plus temporaries
+        frame_memory = height * width * self.vae.config.block_out_channels[0] * element_size * 16
+
+        return max(1, min(num_frames, int(free_memory * 0.8) // frame_memory))
+
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.iter_decode_latents
+    def iter_decode_latents(self, latents, decode_chunk_size: Union[int, str] = 1, output_type: str = "tensor"):
+        r"""
+        Decodes `latents` of shape (b, c, f, h, w) `decode_chunk_size` frames at a time and yields every chunk as
+        soon as it is decoded. The chunks are tensors of shape (n, c, h, w) with values in [0, 1], on the device of
+        the VAE. With `output_type="uint8"` the chunks are converted on the device and yielded as contiguous uint8
+        numpy arrays of shape (n, h, w, c), ready to be handed to an encoder. Frames are yielded in order, one video
+        after the other.
+        """
+        if self.low_vram_mode:
+            self.get_offloader().require("vae")
+
         latents = 1 / self.vae.config.scaling_factor * latents
+        chunk_size = self.get_decode_chunk_size(latents, decode_chunk_size)
         latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in tqdm(range(latents.shape[0])):
-            video.append(self.vae.decode(
-                latents[frame_idx:frame_idx+1]).sample)
-        video = torch.cat(video)
+
+        for start in tqdm(range(0, latents.shape[0], chunk_size)):
+            frames = self.vae.decode(latents[start:start + chunk_size]).sample
+            frames = (frames / 2.0 + 0.5).clamp(0, 1)
+
+            if output_type == "uint8":
+                # scaled and truncated in float32, like torchvision's ToPILImage does
+                frames = frames.float().mul_(255).to(torch.uint8)
+                frames = frames.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+            yield frames
+
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.decode_latents
+    def decode_latents(self, latents, decode_chunk_size: Union[int, str] = 1):
+        video_length = latents.shape[2]
+        video = torch.cat(list(self.iter_decode_latents(latents, decode_chunk_size=decode_chunk_size)))
         video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2.0 + 0.5).clamp(0, 1)
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
         video = video.cpu().float().numpy()
         return video
@@ -1326,6 +1570,24 @@ class HotshotXLControlNetPipeline(
             unet_config=self.unet.config,
             **kwargs,
         )
+        self.load_parsed_lora_weights(state_dict, network_alphas=network_alphas)
+
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline.load_parsed_lora_weights
+    def load_parsed_lora_weights(self, state_dict: Dict[str, torch.Tensor], network_alphas: Optional[Dict[str, float]] = None):
+        r"""
+        Attaches a LoRA that was already parsed with [`~loaders.LoraLoaderMixin.lora_state_dict`] to the unet and both
+        text encoders. This skips reading and converting the weights, so adapters kept in memory can be swapped in
+        quickly. Use [`~loaders.LoraLoaderMixin.unload_lora_weights`] to detach it again.
+
+        Args:
+            state_dict (`Dict[str, torch.Tensor]`):
+                The LoRA state dict as returned by `lora_state_dict`. It is not modified.
+            network_alphas (`Dict[str, float]`, *optional*):
+                The network alphas as returned by `lora_state_dict`.
+        """
+        state_dict = dict(state_dict)
+        network_alphas = dict(network_alphas) if network_alphas is not None else None
+
         self.load_lora_into_unet(state_dict, network_alphas=network_alphas, unet=self.unet)
 
         text_encoder_state_dict = {k: v for k, v in state_dict.items() if "text_encoder." in k}
@@ -1337,6 +1599,7 @@ class HotshotXLControlNetPipeline(
                 prefix="text_encoder",
                 lora_scale=self.lora_scale,
             )
+            mark_text_encoder_lora_changed(self.text_encoder)
 
         text_encoder_2_state_dict = {k: v for k, v in state_dict.items() if "text_encoder_2." in k}
         if len(text_encoder_2_state_dict) > 0:
@@ -1347,6 +1610,7 @@ class HotshotXLControlNetPipeline(
                 prefix="text_encoder_2",
                 lora_scale=self.lora_scale,
             )
+            mark_text_encoder_lora_changed(self.text_encoder_2)
 
     @classmethod
     # Copied from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl.StableDiffusionXLPipeline.save_lora_weights
@@ -1383,7 +1647,9 @@ class HotshotXLControlNetPipeline(
             safe_serialization=safe_serialization,
         )
 
-    # Copied from diffusers.pipelines.stable_diffusion_xl.pipeline_stable_diffusion_xl.StableDiffusionXLPipeline._remove_text_encoder_monkey_patch
+    # Copied from hotshot_xl.pipelines.hotshot_xl_pipeline.HotshotXLPipeline._remove_text_encoder_monkey_patch
     def _remove_text_encoder_monkey_patch(self):
         self._remove_text_encoder_monkey_patch_classmethod(self.text_encoder)
         self._remove_text_encoder_monkey_patch_classmethod(self.text_encoder_2)
+        mark_text_encoder_lora_changed(self.text_encoder)
+        mark_text_encoder_lora_changed(self.text_encoder_2)
@@ -21,9 +21,12 @@ import os
 import inspect
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
 from hotshot_xl import HotshotPipelineXLOutput
+from hotshot_xl.pipelines.offload import ModelOffloader
+from hotshot_xl.pipelines.prompt_cache import PromptEmbeddingCache, mark_text_encoder_lora_changed
 
 from diffusers.image_processor import VaeImageProcessor
 from diffusers.loaders import FromSingleFileMixin, LoraLoaderMixin, TextualInversionLoaderMixin
@@ -47,7 +50,6 @@ from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 from tqdm import tqdm
 from einops import repeat, rearrange
 from diffusers.utils import deprecate, logging
-import gc
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -157,6 +159,10 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
         self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor)
         self.default_sample_size = self.unet.config.sample_size
         self.watermark = None
+        self.prompt_embedding_cache = None
+        self.low_vram_mode = False
+        self.offload_reserve_bytes = None
+        self.offloader = None
 
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.enable_vae_slicing
     def enable_vae_slicing(self):
@@ -324,14 +330,8 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
                         f" {tokenizer.model_max_length} tokens: {removed_text}"
                     )
 
-                prompt_embeds = text_encoder(
-                    text_input_ids.to(device),
-                    output_hidden_states=True,
-                )
-
                 # We are only ALWAYS interested in the pooled output of the final text encoder
-                pooled_prompt_embeds = prompt_embeds[0]
-                prompt_embeds = prompt_embeds.hidden_states[-2]
+                pooled_prompt_embeds, prompt_embeds = self._encode_text(text_encoder, text_input_ids, device)
 
                 prompt_embeds_list.append(prompt_embeds)
 
@@ -377,13 +377,10 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
                     return_tensors="pt",
                 )
 
-                negative_prompt_embeds = text_encoder(
-                    uncond_input.input_ids.to(device),
-                    output_hidden_states=True,
-                )
                 # We are only ALWAYS interested in the pooled output of the final text encoder
-                negative_pooled_prompt_embeds = negative_prompt_embeds[0]
-                negative_prompt_embeds = negative_prompt_embeds.hidden_states[-2]
+                negative_pooled_prompt_embeds, negative_prompt_embeds = self._encode_text(
+                    text_encoder, uncond_input.input_ids, device
+                )
 
                 negative_prompt_embeds_list.append(negative_prompt_embeds)
 
@@ -412,6 +409,45 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
 
         return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
 
+    def enable_prompt_embedding_cache(self, cache: Optional[PromptEmbeddingCache] = None, max_entries: int = 64):
+        r"""
+        Caches the text encoder outputs of prompts and negative prompts, so repeated prompts (e.g. the same negative
+        prompt for every request, or a re-roll with a new seed) skip text encoding. Pass the same `cache` to several
+        pipelines to share the cached embeddings between them.
+        """
+        self.prompt_embedding_cache = cache if cache is not None else PromptEmbeddingCache(max_entries=max_entries)
+
+    def disable_prompt_embedding_cache(self):
+        r"""
+        Disable the prompt embedding cache enabled with `enable_prompt_embedding_cache`.
+        """
+        self.prompt_embedding_cache = None
+
+    def get_offloader(self, device: Optional[torch.device] = None) -> ModelOffloader:
+        r"""
+        Returns the [`ModelOffloader`] that moves every component but the unet between `device` (the device of the
+        unet by default) and the CPU in low VRAM mode, creating it on first use. Components stay resident across
+        calls as long as `offload_reserve_bytes` of device memory stay free, see [`ModelOffloader`].
+        """
+        device = ModelOffloader.normalize_device(device or self.unet.device)
+
+        if self.offloader is None or self.offloader.device != device:
+            self.offloader = ModelOffloader(device)
+            for name, component in self.components.items():
+                if isinstance(component, torch.nn.Module) and name != "unet":
+                    self.offloader.register(name, component)
+
+        self.offloader.reserve_bytes = self.offload_reserve_bytes
+        return self.offloader
+
+    def _encode_text(self, text_encoder, input_ids, device):
+        # returns the pooled output and the penultimate hidden states of the text encoder
+        if self.prompt_embedding_cache is not None:
+            return self.prompt_embedding_cache.encode(text_encoder, input_ids, device, lora_scale=self.lora_scale)
+
+        output = text_encoder(input_ids.to(device), output_hidden_states=True)
+        return output[0], output.hidden_states[-2]
+
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.prepare_extra_step_kwargs
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -588,7 +624,15 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
         original_size: Optional[Tuple[int, int]] = None,
         crops_coords_top_left: Tuple[int, int] = (0, 0),
         target_size: Optional[Tuple[int, int]] = None,
-        low_vram_mode: Optional[bool] = False
+        low_vram_mode: Optional[bool] = False,
+        offload_reserve_bytes: Optional[int] = None,
+        decode_chunk_size: Union[int, str] = 1,
+        context_length: Optional[int] = None,
+        context_stride: Optional[int] = None,
+        deep_cache_interval: Optional[int] = None,
+        deep_cache_depth: int = 1,
+        cfg_end: Optional[float] = None,
+        cfg_interval: int = 1,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -654,8 +698,9 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
                 weighting. If not provided, pooled negative_prompt_embeds will be generated from `negative_prompt`
                 input argument.
             output_type (`str`, *optional*, defaults to `"pil"`):
-                The output format of the generate image. Choose between
-                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
+                The output format of the generated video. Choose between `"tensor"`, `np.array`, `"uint8"` for a
+                uint8 numpy array of shape (b, f, h, w, c), or `"latent"` to skip decoding and return the latents as
+                a tensor of shape (b, c, f, h, w).
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion_xl.StableDiffusionXLPipelineOutput`] instead
                 of a plain tuple.
@@ -688,6 +733,39 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
                 For most cases, `target_size` should be set to the desired height and width of the generated image. If
                 not specified it will default to `(width, height)`. Part of SDXL's micro-conditioning as explained in
                 section 2.2 of [https://huggingface.co/papers/2307.01952](https://huggingface.co/papers/2307.01952).
+            low_vram_mode (`bool`, *optional*, defaults to `False`):
+                Keep only the components needed for the current stage (text encoding, denoising, decoding) on the
+                device, see [`get_offloader`].
+            offload_reserve_bytes (`int`, *optional*):
+                In low VRAM mode, only offload components until this many bytes of device memory are free, so
+                components that fit stay on the device across calls. By default every component not needed for the
+                current stage is offloaded.
+            decode_chunk_size (`int` or `str`, *optional*, defaults to 1):
+                The number of frames decoded by the VAE at once. Higher values decode faster but need more memory.
+                Pass `"auto"` to pick the largest chunk size that fits into the free CUDA memory.
+            context_length (`int`, *optional*):
+                Denoise the video in overlapping windows of `context_length` frames instead of all frames at once.
+                The predictions of overlapping windows are blended every step, so long videos can be generated with
+                the memory needed for a single window. Defaults to denoising all frames at once.
+            context_stride (`int`, *optional*):
+                The number of frames between the starts of two consecutive windows. Defaults to half of
+                `context_length`.
+            deep_cache_interval (`int`, *optional*):
+                Only run the full unet every `deep_cache_interval` steps and reuse its deep features in the steps in
+                between, which only run the shallow blocks (see [`UNet3DConditionModel.enable_deep_cache`]). Higher
+                values are faster but drift further from the uncached output. Can't be combined with
+                `context_length` or `cfg_interval`. With `cfg_end`, the first step after the end of guidance runs
+                the full unet, since the cached features belong to the guided batch of twice the size.
+            deep_cache_depth (`int`, *optional*, defaults to 1):
+                The number of down and up blocks that are still computed in the cached steps.
+            cfg_end (`float`, *optional*):
+                The fraction of the denoising steps, between 0 and 1, that apply classifier free guidance. The
+                remaining steps only run the conditional branch, with half the batch size. Defaults to guiding all
+                steps.
+            cfg_interval (`int`, *optional*, defaults to 1):
+                Only run the unconditional branch every `cfg_interval` guided steps. The guided steps in between only
+                run the conditional branch and extrapolate the unconditional one from the last difference between both
+                branches. Can't be combined with `deep_cache_interval`.
 
         Examples:
 
@@ -697,6 +775,7 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
             `tuple`. When returning a tuple, the first element is a list with the generated images.
         """
         self.low_vram_mode = low_vram_mode
+        self.offload_reserve_bytes = offload_reserve_bytes
 
         if video_length > 1:
             print(f"Warning - setting num_images_per_prompt = 1 because video_length = {video_length}")
@@ -732,16 +811,32 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
         else:
             batch_size = prompt_embeds.shape[0]
 
-        device = self._execution_device
+        # in low VRAM mode the other components may still be offloaded, but the unet always stays on the device
+        device = self.unet.device if self.low_vram_mode else self._execution_device
 
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
         # corresponds to doing no classifier free guidance.
         do_classifier_free_guidance = guidance_scale > 1.0
 
+        if cfg_end is not None and not 0 <= cfg_end <= 1:
+            raise ValueError(f"`cfg_end` has to be between 0 and 1 but is {cfg_end}.")
+
+        if cfg_interval < 1:
+            raise ValueError(f"`cfg_interval` has to be at least 1 but is {cfg_interval}.")
+
+        # the deep features are only cached for the batch of the last full unet pass. Alternating between steps with
+        # and without the unconditional branch would keep discarding them
+        if (
+            do_classifier_free_guidance
+            and cfg_interval > 1
+            and deep_cache_interval is not None
+            and deep_cache_interval > 1
+        ):
+            raise ValueError("`deep_cache_interval` can't be combined with `cfg_interval`.")
+
         if self.low_vram_mode:
-            self.text_encoder.to(device)
-            self.text_encoder_2.to(device)
+            self.get_offloader(device).require("text_encoder", "text_encoder_2")
 
         # 3. Encode input prompt
         text_encoder_lora_scale = (
@@ -768,12 +863,8 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
         )
 
         if self.low_vram_mode:
-            self.text_encoder.to(torch.device("cpu"))
-            self.text_encoder_2.to(torch.device("cpu"))
-            self.vae.to(torch.device("cpu"))
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-            gc.collect()
+            # only the unet is needed while denoising
+            self.get_offloader(device).require()
 
         # 4. Prepare timesteps
         self.scheduler.set_timesteps(num_inference_steps, device=device)
@@ -817,6 +908,18 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
         # 8. Denoising loop
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
 
+        context_windows = None
+        if context_length is not None and context_length < video_length:
+            context_windows = self.get_context_windows(video_length, context_length, context_stride)
+
+        if deep_cache_interval is not None and deep_cache_interval > 1:
+            if context_windows is not None:
+                raise ValueError("`deep_cache_interval` can't be combined with `context_length`.")
+            self.unet.enable_deep_cache(deep_cache_depth)
+        else:
+            deep_cache_interval = None
+            self.unet.disable_deep_cache()
+
         # 7.1 Apply denoising_end
         if denoising_end is not None and type(denoising_end) == float and denoising_end > 0 and denoising_end < 1:
             discrete_timestep_cutoff = int(
@@ -828,31 +931,62 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
             num_inference_steps = len(list(filter(lambda ts: ts >= discrete_timestep_cutoff, timesteps)))
             timesteps = timesteps[:num_inference_steps]
 
+        # the steps that apply guidance, and the conditional half of the batch for the steps that skip the
+        # unconditional branch
+        num_guidance_steps = len(timesteps) if cfg_end is None else int(round(cfg_end * len(timesteps)))
+        cond_batch = slice(prompt_embeds.shape[0] // 2, None) if do_classifier_free_guidance else slice(None)
+        guidance_delta = None
+
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
+                if self.low_vram_mode and i == len(timesteps) - 1:
+                    # copy the vae to the device while the last step is running
+                    self.get_offloader(device).prefetch("vae")
+
+                guidance_step = do_classifier_free_guidance and i < num_guidance_steps
+                run_uncond = guidance_step and (guidance_delta is None or i % cfg_interval == 0)
+                batch = slice(None) if run_uncond else cond_batch
+
                 # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+                latent_model_input = torch.cat([latents] * 2) if run_uncond else latents
 
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
                 # predict the noise residual
-                added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
-                noise_pred = self.unet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=prompt_embeds,
-                    cross_attention_kwargs=cross_attention_kwargs,
-                    added_cond_kwargs=added_cond_kwargs,
-                    return_dict=False,
-                    enable_temporal_attentions= video_length > 1
-                )[0]
+                added_cond_kwargs = {"text_embeds": add_text_embeds[batch], "time_ids": add_time_ids[batch]}
+                if context_windows is None:
+                    noise_pred = self.unet(
+                        latent_model_input,
+                        t,
+                        encoder_hidden_states=prompt_embeds[batch],
+                        cross_attention_kwargs=cross_attention_kwargs,
+                        added_cond_kwargs=added_cond_kwargs,
+                        return_dict=False,
+                        enable_temporal_attentions= video_length > 1,
+                        use_deep_cache=deep_cache_interval is not None and i % deep_cache_interval != 0,
+                    )[0]
+                else:
+                    noise_pred = self.predict_noise_in_windows(
+                        latent_model_input,
+                        t,
+                        context_windows,
+                        encoder_hidden_states=prompt_embeds[batch],
+                        cross_attention_kwargs=cross_attention_kwargs,
+                        added_cond_kwargs=added_cond_kwargs,
+                    )
 
                 # perform guidance
-                if do_classifier_free_guidance:
+                if run_uncond:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-                if do_classifier_free_guidance and guidance_rescale > 0.0:
+                    if cfg_interval > 1:
+                        guidance_delta = noise_pred_text - noise_pred_uncond
+                elif guidance_step:
+                    # extrapolate the unconditional branch from the last step that ran it
+                    noise_pred_text = noise_pred
+                    noise_pred = noise_pred_text + (guidance_scale - 1) * guidance_delta
+
+                if guidance_step and guidance_rescale > 0.0:
                     # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
                     noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=guidance_rescale)
 
@@ -865,6 +999,13 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
                     if callback is not None and i % callback_steps == 0:
                         callback(i, t, latents)
 
+        # free the cached features
+        self.unet.disable_deep_cache()
+
+        if self.low_vram_mode:
+            # wait for the prefetch of the vae before the upcast below reads its weights
+            self.get_offloader(device).require("vae")
+
         # make sure the VAE is in float32 mode, as it overflows in float16
         if self.vae.dtype == torch.float16 and self.vae.config.force_upcast:
             self.upcast_vae()
@@ -882,17 +1023,19 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
 
         #image = self.image_processor.postprocess(image, output_type=output_type)
 
-        if self.low_vram_mode:
-            self.vae.to(device)
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-            gc.collect()
-
-        video = self.decode_latents(latents)
+        if output_type == "latent":
+            video = latents
+        elif output_type == "uint8":
+            video = np.concatenate(list(
+                self.iter_decode_latents(latents, decode_chunk_size=decode_chunk_size, output_type="uint8")
+            ))
+            video = video.reshape(latents.shape[0], latents.shape[2], *video.shape[1:])
+        else:
+            video = self.decode_latents(latents, decode_chunk_size=decode_chunk_size)
 
-        # Convert to tensor
-        if output_type == "tensor":
-            video = torch.from_numpy(video)
+            # Convert to tensor
+            if output_type == "tensor":
+                video = torch.from_numpy(video)
 
         if not return_dict:
             return video
@@ -909,6 +1052,61 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
         #
         # return StableDiffusionXLPipelineOutput(images=image)
 
+    @staticmethod
+    def get_context_windows(video_length: int, context_length: int, context_stride: Optional[int] = None) -> List[slice]:
+        r"""
+        Splits `video_length` frames into overlapping windows of `context_length` frames, starting every
+        `context_stride` frames. The last window always ends at the last frame.
+        """
+        if context_length < 1:
+            raise ValueError(f"`context_length` has to be at least 1 but is {context_length}.")
+
+        if context_stride is None:
+            context_stride = max(context_length // 2, 1)
+        elif context_stride < 1:
+            raise ValueError(f"`context_stride` has to be at least 1 but is {context_stride}.")
+
+        if context_stride > context_length:
+            raise ValueError(
+                f"`context_stride` ({context_stride}) can't be larger than `context_length` ({context_length}), "
+                "otherwise some frames would never be denoised."
+            )
+
+        starts = list(range(0, video_length - context_length + 1, context_stride))
+        if starts[-1] + context_length < video_length:
+            starts.append(video_length - context_length)
+
+        return [slice(start, start + context_length) for start in starts]
+
+    def predict_noise_in_windows(self, latent_model_input, t, context_windows: List[slice], **unet_kwargs):
+        r"""
+        Predicts the noise of every context window separately and blends the overlapping frames. Frames near the
+        center of a window are weighted more than frames at its edges, which hides the seams between windows.
+        """
+        noise_pred = torch.zeros_like(latent_model_input)
+        total_weight = torch.zeros(
+            (1, 1, latent_model_input.shape[2], 1, 1), device=latent_model_input.device, dtype=latent_model_input.dtype
+        )
+
+        for window in context_windows:
+            window_length = window.stop - window.start
+            positions = torch.arange(window_length, device=latent_model_input.device)
+            weight = torch.minimum(positions + 1, window_length - positions).to(latent_model_input.dtype)
+            weight = weight[None, None, :, None, None]
+
+            window_noise_pred = self.unet(
+                latent_model_input[:, :, window],
+                t,
+                return_dict=False,
+                enable_temporal_attentions=window_length > 1,
+                **unet_kwargs,
+            )[0]
+
+            noise_pred[:, :, window] += window_noise_pred * weight
+            total_weight[:, :, window] += weight
+
+        return noise_pred / total_weight
+
     # Overrride to properly handle the loading and unloading of the additional text encoder.
     def load_lora_weights(self, pretrained_model_name_or_path_or_dict: Union[str, Dict[str, torch.Tensor]], **kwargs):
         # We could have accessed the unet config from `lora_state_dict()` too. We pass
@@ -919,6 +1117,23 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
             unet_config=self.unet.config,
             **kwargs,
         )
+        self.load_parsed_lora_weights(state_dict, network_alphas=network_alphas)
+
+    def load_parsed_lora_weights(self, state_dict: Dict[str, torch.Tensor], network_alphas: Optional[Dict[str, float]] = None):
+        r"""
+        Attaches a LoRA that was already parsed with [`~loaders.LoraLoaderMixin.lora_state_dict`] to the unet and both
+        text encoders. This skips reading and converting the weights, so adapters kept in memory can be swapped in
+        quickly. Use [`~loaders.LoraLoaderMixin.unload_lora_weights`] to detach it again.
+
+        Args:
+            state_dict (`Dict[str, torch.Tensor]`):
+                The LoRA state dict as returned by `lora_state_dict`. It is not modified.
+            network_alphas (`Dict[str, float]`, *optional*):
+                The network alphas as returned by `lora_state_dict`.
+        """
+        state_dict = dict(state_dict)
+        network_alphas = dict(network_alphas) if network_alphas is not None else None
+
         self.load_lora_into_unet(state_dict, network_alphas=network_alphas, unet=self.unet)
 
         text_encoder_state_dict = {k: v for k, v in state_dict.items() if "text_encoder." in k}
@@ -930,6 +1145,7 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
                 prefix="text_encoder",
                 lora_scale=self.lora_scale,
             )
+            mark_text_encoder_lora_changed(self.text_encoder)
 
         text_encoder_2_state_dict = {k: v for k, v in state_dict.items() if "text_encoder_2." in k}
         if len(text_encoder_2_state_dict) > 0:
@@ -940,6 +1156,7 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
                 prefix="text_encoder_2",
                 lora_scale=self.lora_scale,
             )
+            mark_text_encoder_lora_changed(self.text_encoder_2)
 
     @classmethod
     def save_lora_weights(
@@ -975,18 +1192,80 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
             safe_serialization=safe_serialization,
         )
 
-    def decode_latents(self, latents):
-        video_length = latents.shape[2]
+    @torch.no_grad()
+    def stream(self, *args, decode_chunk_size: Union[int, str] = 1, output_type: str = "tensor", **kwargs):
+        r"""
+        Runs the pipeline like `__call__`, but yields the decoded frames chunk by chunk while the VAE is still
+        decoding the rest of the video, so they can be encoded or sent right away.
+
+        Takes the same arguments as `__call__` (`return_dict` is ignored). With `output_type="tensor"` every chunk
+        is a float32 CPU tensor of shape (n, c, h, w) with values in [0, 1], with `output_type="uint8"` it's a
+        contiguous uint8 numpy array of shape (n, h, w, c). Frames are yielded in order, one video after the other.
+        """
+        kwargs.update(output_type="latent", return_dict=False)
+        latents = self(*args, **kwargs)
+
+        for frames in self.iter_decode_latents(latents, decode_chunk_size=decode_chunk_size, output_type=output_type):
+            yield frames if output_type == "uint8" else frames.cpu().float()
+
+    def get_decode_chunk_size(self, latents, decode_chunk_size: Union[int, str] = "auto") -> int:
+        r"""
+        Returns the number of frames to decode per VAE call for `latents` of shape (b, c, f, h, w).
+
+        With `decode_chunk_size="auto"` the chunk size is derived from the free CUDA memory, using a rough estimate
+        of the peak memory needed to decode a single frame. Off CUDA, frames are decoded one at a time.
+        """
+        num_frames = latents.shape[0] * latents.shape[2]
+
+        if decode_chunk_size != "auto":
+            return max(1, min(int(decode_chunk_size), num_frames))
+
+        device = self.vae.device
+        if device.type != "cuda":
+            return 1
+
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        # memory held by the caching allocator but not used by any tensor is free as well
+        free_memory += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+        height = latents.shape[-2] * self.vae_scale_factor
+        width = latents.shape[-1] * self.vae_scale_factor
+        element_size = torch.tensor([], dtype=self.vae.dtype).element_size()
+        # the full resolution decoder blocks dominate, count their activations plus temporaries
+        frame_memory = height * width * self.vae.config.block_out_channels[0] * element_size * 16
+
+        return max(1, min(num_frames, int(free_memory * 0.8) // frame_memory))
+
+    def iter_decode_latents(self, latents, decode_chunk_size: Union[int, str] = 1, output_type: str = "tensor"):
+        r"""
+        Decodes `latents` of shape (b, c, f, h, w) `decode_chunk_size` frames at a time and yields every chunk as
+        soon as it is decoded. The chunks are tensors of shape (n, c, h, w) with values in [0, 1], on the device of
+        the VAE. With `output_type="uint8"` the chunks are converted on the device and yielded as contiguous uint8
+        numpy arrays of shape (n, h, w, c), ready to be handed to an encoder. Frames are yielded in order, one video
+        after the other.
+        """
+        if self.low_vram_mode:
+            self.get_offloader().require("vae")
+
         latents = 1 / self.vae.config.scaling_factor * latents
+        chunk_size = self.get_decode_chunk_size(latents, decode_chunk_size)
         latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in tqdm(range(latents.shape[0])):
-            video.append(self.vae.decode(
-                latents[frame_idx:frame_idx+1]).sample)
-        video = torch.cat(video)
+
+        for start in tqdm(range(0, latents.shape[0], chunk_size)):
+            frames = self.vae.decode(latents[start:start + chunk_size]).sample
+            frames = (frames / 2.0 + 0.5).clamp(0, 1)
+
+            if output_type == "uint8":
+                # scaled and truncated in float32, like torchvision's ToPILImage does
+                frames = frames.float().mul_(255).to(torch.uint8)
+                frames = frames.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+            yield frames
+
+    def decode_latents(self, latents, decode_chunk_size: Union[int, str] = 1):
+        video_length = latents.shape[2]
+        video = torch.cat(list(self.iter_decode_latents(latents, decode_chunk_size=decode_chunk_size)))
         video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2.0 + 0.5).clamp(0, 1)
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
         video = video.cpu().float().numpy()
         return video
@@ -994,3 +1273,5 @@ class HotshotXLPipeline(DiffusionPipeline, FromSingleFileMixin, LoraLoaderMixin)
     def _remove_text_encoder_monkey_patch(self):
         self._remove_text_encoder_monkey_patch_classmethod(self.text_encoder)
         self._remove_text_encoder_monkey_patch_classmethod(self.text_encoder_2)
+        mark_text_encoder_lora_changed(self.text_encoder)
+        mark_text_encoder_lora_changed(self.text_encoder_2)
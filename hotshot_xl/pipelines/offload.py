@@ -0,0 +1,158 @@
+# Copyright 2023 Natural Synthetics Inc. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+
+import itertools
+from collections import OrderedDict
+from typing import Optional, Union
+
+import torch
+from torch.utils.weak import WeakIdKeyDictionary
+
+
+class ModelOffloader:
+    """
+    Moves pipeline components between the execution device and the CPU, and keeps track of where each one is.
+
+    `require` makes components resident before they are used and offloads the least recently used other
+    components until `reserve_bytes` of device memory are free, or all of them when `reserve_bytes` is None. With
+    enough memory, components stay resident and nothing is moved again for consecutive requests. `prefetch`
+    starts copying a component to the device on a side CUDA stream, so the copy overlaps with the work on the
+    main stream, and the following `require` waits for it on the device instead of the host. Offloaded weights
+    are kept in pinned memory so these copies can run asynchronously.
+    """
+
+    def __init__(self, device: Union[str, torch.device], reserve_bytes: Optional[int] = None):
+        self.device = self.normalize_device(device)
+        self.reserve_bytes = reserve_bytes
+        # least recently required first
+        self._modules = OrderedDict()
+        self._resident = set()
+        self._prefetching = {}
+        # keyed by identity, a WeakKeyDictionary compares its keys with `==`, which is element wise for tensors
+        self._pinned = WeakIdKeyDictionary()
+        self._stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    @staticmethod
+    def normalize_device(device: Union[str, torch.device]) -> torch.device:
+        device = torch.device(device)
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        return device
+
+    def __contains__(self, name: str):
+        return name in self._modules
+
+    def register(self, name: str, module: Optional[torch.nn.Module]):
+        """
+        Starts tracking `module` under `name`. `None` modules are ignored, like optional pipeline components.
+        """
+        if module is None:
+            return
+
+        self._modules[name] = module
+        tensor = next(self._tensors(module), None)
+        if tensor is not None and tensor.device == self.device:
+            self._resident.add(name)
+
+    def is_resident(self, name: str) -> bool:
+        return name in self._resident
+
+    def require(self, *names: str):
+        """
+        Makes the components `names` resident and offloads other components as needed. Names that aren't
+        registered are ignored.
+        """
+        names = [name for name in names if name in self._modules]
+
+        for name in names:
+            self._modules.move_to_end(name)
+
+        missing = [name for name in names if name not in self._resident and name not in self._prefetching]
+        self._make_room(keep=names, needed=sum(self._size(name) for name in missing))
+
+        for name in names:
+            if name in self._prefetching:
+                self._finish_prefetch(name)
+            elif name not in self._resident:
+                self._move(self._modules[name], self.device)
+                self._resident.add(name)
+
+    def prefetch(self, name: str):
+        """
+        Starts copying the component `name` to the device on a side stream, if it isn't resident already. Only has
+        an effect on CUDA devices, elsewhere the component is loaded by the next `require`.
+        """
+        if name not in self._modules or name in self._resident or name in self._prefetching:
+            return
+
+        if self._stream is None:
+            return
+
+        self._make_room(keep=[name], needed=self._size(name))
+
+        # don't overtake work that was queued on the main stream before
+        self._stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self._stream):
+            self._move(self._modules[name], self.device, non_blocking=True)
+            self._prefetching[name] = self._stream.record_event()
+
+    def _finish_prefetch(self, name: str):
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(self._prefetching.pop(name))
+        # the weights were allocated on the side stream but are used on the main stream from now on
+        for tensor in self._tensors(self._modules[name]):
+            tensor.data.record_stream(stream)
+        self._resident.add(name)
+
+    def _make_room(self, keep, needed: int):
+        offloaded = False
+
+        for name in list(self._modules):
+            if name in keep or (name not in self._resident and name not in self._prefetching):
+                continue
+
+            if self.reserve_bytes is not None and self._free_memory() >= needed + self.reserve_bytes:
+                break
+
+            if name in self._prefetching:
+                self._finish_prefetch(name)
+
+            self._move(self._modules[name], torch.device("cpu"))
+            self._resident.discard(name)
+            offloaded = True
+
+        if offloaded and self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def _free_memory(self) -> int:
+        if self.device.type != "cuda":
+            return 0
+
+        free_memory, _ = torch.cuda.mem_get_info(self.device)
+        # memory held by the caching allocator but not used by any tensor is free as well
+        return free_memory + torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+
+    def _size(self, name: str) -> int:
+        return sum(tensor.numel() * tensor.element_size() for tensor in self._tensors(self._modules[name]))
+
+    @staticmethod
+    def _tensors(module: torch.nn.Module):
+        return itertools.chain(module.parameters(), module.buffers())
+
+    def _move(self, module: torch.nn.Module, device: torch.device, non_blocking: bool = False):
+        for tensor in self._tensors(module):
+            if device.type == "cpu":
+                # reuse the pinned copy from the last time the tensor was offloaded
+                pinned = self._pinned.get(tensor)
+                if pinned is None or pinned.shape != tensor.shape or pinned.dtype != tensor.dtype:
+                    pinned = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+                    self._pinned[tensor] = pinned
+                pinned.copy_(tensor.data)
+                tensor.data = pinned
+            else:
+                tensor.data = tensor.data.to(device, non_blocking=non_blocking)
@@ -0,0 +1,82 @@
+# Copyright 2023 Natural Synthetics Inc. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+
+_lora_tokens = itertools.count()
+
+
+def mark_text_encoder_lora_changed(text_encoder: Optional[torch.nn.Module]):
+    """
+    Gives `text_encoder` a new LoRA token, so embeddings cached while a different LoRA (or none) was attached to
+    it are not reused. Has to be called whenever LoRA layers are attached to or removed from a text encoder.
+    """
+    if text_encoder is not None:
+        text_encoder._hotshot_lora_token = next(_lora_tokens)
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of text encoder outputs.
+
+    Entries are keyed by the text encoder, the token ids, the device and the LoRA attached to the text encoder
+    (together with the LoRA scale), so the cache can be shared between pipelines using the same text encoders.
+    The cached tensors are treated as read only.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def encode(self,
+               text_encoder: torch.nn.Module,
+               input_ids: torch.Tensor,
+               device: torch.device,
+               lora_scale: Optional[float] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns `(pooled_output, penultimate_hidden_states)` for `input_ids`, running `text_encoder` on a cache
+        miss.
+        """
+        lora_token = getattr(text_encoder, "_hotshot_lora_token", None)
+        key = (
+            id(text_encoder),
+            tuple(input_ids.shape),
+            input_ids.numpy().tobytes(),
+            str(device),
+            text_encoder.dtype,
+            lora_token,
+            lora_scale if lora_token is not None else None,
+        )
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        output = text_encoder(input_ids.to(device), output_hidden_states=True)
+        value = (output[0].detach(), output.hidden_states[-2].detach())
+
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return value
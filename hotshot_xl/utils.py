@@ -12,14 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Union
+from typing import BinaryIO, List, Union
 from io import BytesIO
 import PIL
-from PIL import ImageSequence, Image
+from PIL import ImageSequence, Image, GifImagePlugin
 import requests
 import os
+import subprocess
+import tempfile
+import threading
 import numpy as np
 import imageio
+import imageio_ffmpeg
 
 
 def get_image(img_path) -> PIL.Image.Image:
@@ -45,8 +49,9 @@ def images_to_gif_bytes(images: List, duration: int = 1000) -> bytes:
     return gif_bytes
 
 def save_as_gif(images: List, file_path: str, duration: int = 1000):
-    with open(file_path, "wb") as f:
-        f.write(images_to_gif_bytes(images, duration))
+    with GifWriter(file_path, duration=duration) as writer:
+        for img in images:
+            writer.append(img)
 
 def images_to_mp4_bytes(images: List[Image.Image], duration: int = 1000) -> bytes:
         with BytesIO() as output_buffer:
@@ -58,8 +63,181 @@ def images_to_mp4_bytes(images: List[Image.Image], duration: int = 1000) -> byte
         return mp4_bytes
 
 def save_as_mp4(images: List[Image.Image], file_path: str, duration: int = 1000):
-    with open(file_path, "wb") as f:
-        f.write(images_to_mp4_bytes(images, duration))
+    with Mp4Writer(file_path, duration=duration) as writer:
+        for img in images:
+            writer.append(img)
+
+
+Frame = Union[Image.Image, np.ndarray]
+
+
+def frame_to_array(frame: Frame) -> np.ndarray:
+    """
+    Returns a frame given as a PIL image or a (h, w, 3) uint8 array as a contiguous (h, w, 3) uint8 array.
+    """
+    if isinstance(frame, Image.Image):
+        return np.asarray(frame.convert("RGB"))
+    if frame.dtype != np.uint8:
+        raise ValueError(f"Frames passed as arrays have to be uint8 but are {frame.dtype}")
+    return np.ascontiguousarray(frame)
+
+
+def frame_to_image(frame: Frame) -> Image.Image:
+    return frame if isinstance(frame, Image.Image) else Image.fromarray(frame_to_array(frame))
+
+
+class GifWriter:
+    """
+    Writes an animated GIF one frame at a time.
+
+    `target` is a file path or a writable binary file object (e.g. a socket file or a chunked HTTP response).
+    Every frame is written out as soon as it is appended and gets its own color table, so nothing but the current
+    frame is kept in memory. `duration` is the display time of each frame in milliseconds, `loop=0` loops forever.
+    """
+
+    def __init__(self, target: Union[str, os.PathLike, BinaryIO], duration: int = 1000, loop: int = 0):
+        self.duration = duration
+        self.loop = loop
+        self._owns_file = isinstance(target, (str, os.PathLike))
+        self._fp = open(target, "wb") if self._owns_file else target
+        self._size = None
+
+    def append(self, frame: Frame):
+        image = frame_to_image(frame)
+        if image.mode != "P":
+            image = image.convert("RGB").convert("P", palette=Image.Palette.ADAPTIVE)
+
+        if self._size is None:
+            self._size = image.size
+            header, _ = GifImagePlugin.getheader(image, info={"loop": self.loop, "duration": self.duration})
+            for block in header:
+                self._fp.write(block)
+        elif image.size != self._size:
+            raise ValueError(f"All frames need to have the same size, expected {self._size} but got {image.size}")
+
+        for block in GifImagePlugin.getdata(image, duration=self.duration, include_color_table=True):
+            self._fp.write(block)
+
+    def close(self):
+        if self._fp is None:
+            return
+        try:
+            self._fp.write(b";")  # end of file
+            self._fp.flush()
+        finally:
+            if self._owns_file:
+                self._fp.close()
+            self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Mp4Writer:
+    """
+    Encodes an H.264 MP4 one frame at a time.
+
+    When `target` is a file path, ffmpeg writes straight to that file. When it's a writable binary file object, a
+    fragmented MP4 is streamed to it while encoding, so it can be sent to a client before the video is complete.
+    `duration` is the display time of each frame in milliseconds.
+    """
+
+    def __init__(self, target: Union[str, os.PathLike, BinaryIO], duration: int = 1000):
+        self.target = target
+        self.fps = 1 / (duration / 1000)
+        self._writer = None
+        self._process = None
+        self._reader = None
+        self._reader_error = None
+        self._stderr = None
+        self._size = None
+
+        if isinstance(target, (str, os.PathLike)):
+            self._writer = imageio.get_writer(target, format='mp4', fps=self.fps)
+
+    def append(self, frame: Frame):
+        frame = frame_to_array(frame)
+
+        if self._writer is not None:
+            self._writer.append_data(frame)
+            return
+
+        if self._process is None:
+            self._start(frame.shape[1], frame.shape[0])
+        elif (frame.shape[1], frame.shape[0]) != self._size:
+            raise ValueError(f"All frames need to have the same size, expected {self._size} but got "
+                             f"{(frame.shape[1], frame.shape[0])}")
+
+        self._raise_reader_error()
+        self._process.stdin.write(frame.tobytes())
+
+    def _start(self, width: int, height: int):
+        self._size = (width, height)
+        # same codec and quality as imageio's defaults, fragmented so it can be written to a pipe
+        cmd = [
+            imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-vcodec", "rawvideo", "-s", f"{width}x{height}", "-pix_fmt", "rgb24",
+            "-r", f"{self.fps:.02f}", "-i", "-", "-an",
+            "-vcodec", "libx264", "-pix_fmt", "yuv420p", "-crf", "25",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1",
+        ]
+        # stderr goes to a file instead of a pipe, so ffmpeg can't block on it while nobody reads it
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._stderr)
+        self._reader = threading.Thread(target=self._copy_output, args=(self._process.stdout,), daemon=True)
+        self._reader.start()
+
+    def _copy_output(self, stdout):
+        for chunk in iter(lambda: stdout.read(64 * 1024), b""):
+            if self._reader_error is not None:
+                # keep draining the output, so ffmpeg (and `append`) never block on a full pipe
+                continue
+            try:
+                self.target.write(chunk)
+            except BaseException as e:
+                # e.g. the client disconnected, re-raised from `append` or `close`
+                self._reader_error = e
+
+    def _raise_reader_error(self):
+        if self._reader_error is not None:
+            error, self._reader_error = self._reader_error, None
+            raise error
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            return
+
+        if self._process is None:
+            return
+
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._reader.join()
+
+        stderr, self._stderr = self._stderr, None
+        with stderr:
+            returncode = process.wait()
+            self._raise_reader_error()
+            if returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError(f"ffmpeg failed to encode the video: {stderr.read().decode(errors='replace')}")
+
+        if hasattr(self.target, "flush"):
+            self.target.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 def scale_aspect_fill(img, new_width, new_height):
     new_width = int(new_width)
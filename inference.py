@@ -16,17 +16,23 @@ import sys
 
 sys.path.append("/")
 import os
+import time
+import random
 import argparse
+import tempfile
 import torch
 from hotshot_xl.pipelines.hotshot_xl_pipeline import HotshotXLPipeline
 from hotshot_xl.pipelines.hotshot_xl_controlnet_pipeline import HotshotXLControlNetPipeline
 from hotshot_xl.models.unet import UNet3DConditionModel
-import torchvision.transforms as transforms
-from einops import rearrange
-from hotshot_xl.utils import save_as_gif, save_as_mp4, extract_gif_frames_from_midpoint, scale_aspect_fill
+from PIL import Image
+from hotshot_xl.control_frame_cache import ControlFrameCache
+from hotshot_xl.lora_cache import LoraCache
+from hotshot_xl.utils import GifWriter, Mp4Writer, extract_gif_frames_from_midpoint, scale_aspect_fill
 from torch import autocast
 from diffusers import ControlNetModel
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 from diffusers.schedulers.scheduling_euler_ancestral_discrete import EulerAncestralDiscreteScheduler
 from diffusers.schedulers.scheduling_euler_discrete import EulerDiscreteScheduler
 
@@ -37,10 +43,24 @@ SCHEDULERS = {
     # add more here
 }
 
+def decode_chunk_size_type(value: str):
+    return value if value == "auto" else int(value)
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Hotshot-XL inference")
     parser.add_argument("--pretrained_path", type=str, default="hotshotco/Hotshot-XL")
     parser.add_argument("--xformers", action="store_true")
+    parser.add_argument("--folded_frame_layout", action="store_true",
+                        help="keep the unet activations folded to (batch * frames, c, h, w) between spatial layers")
+    parser.add_argument("--channels_last", action="store_true",
+                        help="like --folded_frame_layout, with the activations in the channels last memory format")
+    parser.add_argument("--compile", action="store_true",
+                        help="compile the unet and the vae decoder with torch.compile")
+    parser.add_argument("--compile_cache_dir", type=str, default=None,
+                        help="directory where compiled kernels are kept across runs")
+    parser.add_argument("--compile_max_shapes", type=int, default=8,
+                        help="number of input shapes compiled before torch.compile falls back to eager mode")
     parser.add_argument("--spatial_unet_base", type=str)
     parser.add_argument("--lora", type=str)
     parser.add_argument("--weight_name", type=str)
@@ -59,14 +79,39 @@ def parse_args():
     parser.add_argument("--video_length", type=int, default=8)
     parser.add_argument("--video_duration", type=int, default=1000)
     parser.add_argument("--low_vram_mode", action="store_true")
+    parser.add_argument("--offload_reserve_bytes", type=int, default=None,
+                        help="In low VRAM mode, keep components on the GPU while this many bytes stay free")
+    parser.add_argument("--context_length", type=int, default=None,
+                        help="Denoise the video in overlapping windows of this many frames, for long videos")
+    parser.add_argument("--context_stride", type=int, default=None,
+                        help="Frames between the starts of two windows, defaults to half the context length")
+    parser.add_argument("--deep_cache_interval", type=int, default=None,
+                        help="Run the full unet only every N steps and reuse its deep features in between")
+    parser.add_argument("--deep_cache_depth", type=int, default=1,
+                        help="Number of down/up blocks still computed in the cached steps")
+    parser.add_argument("--cfg_end", type=float, default=None,
+                        help="fraction of the steps that apply classifier free guidance, defaults to all of them")
+    parser.add_argument("--cfg_interval", type=int, default=1,
+                        help="run the unconditional branch only every n guided steps and extrapolate it in between")
+    parser.add_argument("--decode_chunk_size", type=decode_chunk_size_type, default="auto",
+                        help='Number of frames the VAE decodes at once, or "auto" to fit the free GPU memory')
     parser.add_argument('--scheduler', type=str, default='EulerAncestralDiscreteScheduler',
                         help='Name of the scheduler to use')
 
-    parser.add_argument("--control_type", type=str, default=None, choices=["depth", "canny"])
-    parser.add_argument("--controlnet_conditioning_scale", type=float, default=0.7)
-    parser.add_argument("--control_guidance_start", type=float, default=0.0)
-    parser.add_argument("--control_guidance_end", type=float, default=1.0)
-    parser.add_argument("--gif", type=str, default=None)
+    parser.add_argument("--control_type", type=str, default=None, nargs="+", choices=["depth", "canny"],
+                        help="one or more controlnets, which are run together on the frames of their gifs")
+    parser.add_argument("--controlnet_conditioning_scale", type=float, default=[0.7], nargs="+",
+                        help="a single scale for all controlnets or one scale per controlnet")
+    parser.add_argument("--control_guidance_start", type=float, default=[0.0], nargs="+",
+                        help="a single value for all controlnets or one value per controlnet")
+    parser.add_argument("--control_guidance_end", type=float, default=[1.0], nargs="+",
+                        help="a single value for all controlnets or one value per controlnet")
+    parser.add_argument("--controlnet_cache_steps", type=int, default=1,
+                        help="run the controlnet only every n steps and reuse its residuals in between")
+    parser.add_argument("--gif", type=str, default=None, nargs="+",
+                        help="the control gif of every --control_type, in the same order")
+    parser.add_argument("--control_cache_dir", type=str, default=None,
+                        help="directory where the frames extracted from the gif are cached across runs")
     parser.add_argument("--precision", type=str, default='f16', choices=[
         'f16', 'f32', 'bf16'
     ])
@@ -77,22 +122,6 @@ def parse_args():
     return parser.parse_args()
 
 
-to_pil = transforms.ToPILImage()
-
-
-def to_pil_images(video_frames: torch.Tensor, output_type='pil'):
-    video_frames = rearrange(video_frames, "b c f w h -> b f c w h")
-    bsz = video_frames.shape[0]
-    images = []
-    for i in range(bsz):
-        video = video_frames[i]
-        for j in range(video.shape[0]):
-            if output_type == "pil":
-                images.append(to_pil(video[j]))
-            else:
-                images.append(video[j])
-    return images
-
 @contextmanager
 def maybe_auto_cast(data_type):
     if data_type:
@@ -102,37 +131,42 @@ def maybe_auto_cast(data_type):
         yield
 
 
-def main():
-    args = parse_args()
-
-    if args.control_type and not args.gif:
-        raise ValueError("Controlnet specified but you didn't specify a gif!")
-
-    if args.gif and not args.control_type:
-        print("warning: gif was specified but no control type was specified. gif will be ignored.")
-
-    output_dir = os.path.dirname(args.output)
-    if output_dir:
-        os.makedirs(output_dir, exist_ok=True)
+PRECISIONS = {
+    'f16': torch.half,
+    'f32': torch.float32,
+    'bf16': torch.bfloat16,
+}
 
-    device = torch.device("cuda")
+AUTOCAST_TYPES = {
+    'f16': torch.half,
+    'bf16': torch.bfloat16,
+}
 
-    control_net_model_pretrained_path = None
-    if args.control_type:
-        control_type_to_model_map = {
-            "canny": "diffusers/controlnet-canny-sdxl-1.0",
-            "depth": "diffusers/controlnet-depth-sdxl-1.0",
-        }
-        control_net_model_pretrained_path = control_type_to_model_map[args.control_type]
+CONTROL_TYPE_TO_MODEL_MAP = {
+    "canny": "diffusers/controlnet-canny-sdxl-1.0",
+    "depth": "diffusers/controlnet-depth-sdxl-1.0",
+}
 
-    data_type = torch.float32
 
-    if args.precision == 'f16':
-        data_type = torch.half
-    elif args.precision == 'f32':
-        data_type = torch.float32
-    elif args.precision == 'bf16':
-        data_type = torch.bfloat16
+def load_pipeline(pretrained_path: str = "hotshotco/Hotshot-XL",
+                  spatial_unet_base: str = None,
+                  control_type: Union[str, Sequence[str]] = None,
+                  precision: str = 'f16',
+                  xformers: bool = False,
+                  folded_frame_layout: bool = False,
+                  channels_last: bool = False,
+                  compile_models: bool = False,
+                  compile_cache_dir: str = None,
+                  compile_max_shapes: int = 8,
+                  device: torch.device = None):
+    """
+    Loads a Hotshot-XL pipeline once so it can be reused across many calls to `generate`.
+    The arguments mirror the model related command line arguments of this script. `compile_max_shapes` has to
+    cover every input shape the compiled models will see (see `warmup`), shapes beyond it run in eager mode.
+    """
+    device = device or torch.device("cuda")
+
+    data_type = PRECISIONS[precision]
 
     pipe_line_args = {
         "torch_dtype": data_type,
@@ -141,16 +175,20 @@ def main():
 
     PipelineClass = HotshotXLPipeline
 
-    if control_net_model_pretrained_path:
+    if control_type:
         PipelineClass = HotshotXLControlNetPipeline
-        pipe_line_args['controlnet'] = \
-            ControlNetModel.from_pretrained(control_net_model_pretrained_path, torch_dtype=data_type)
+        control_types = [control_type] if isinstance(control_type, str) else list(control_type)
+        controlnets = [
+            ControlNetModel.from_pretrained(CONTROL_TYPE_TO_MODEL_MAP[t], torch_dtype=data_type) for t in control_types
+        ]
+        # several controlnets are wrapped into a `MultiControlNetModel` by the pipeline
+        pipe_line_args['controlnet'] = controlnets[0] if len(controlnets) == 1 else controlnets
 
-    if args.spatial_unet_base:
+    if spatial_unet_base:
 
-        unet_3d = UNet3DConditionModel.from_pretrained(args.pretrained_path, subfolder="unet").to(device)
+        unet_3d = UNet3DConditionModel.from_pretrained(pretrained_path, subfolder="unet").to(device)
 
-        unet = UNet3DConditionModel.from_pretrained_spatial(args.spatial_unet_base).to(device)
+        unet = UNet3DConditionModel.from_pretrained_spatial(spatial_unet_base).to(device)
 
         temporal_layers = {}
         unet_3d_sd = unet_3d.state_dict()
@@ -167,79 +205,410 @@ def main():
         del unet_3d
         del temporal_layers
 
-    pipe = PipelineClass.from_pretrained(args.pretrained_path, **pipe_line_args).to(device)
+    pipe = PipelineClass.from_pretrained(pretrained_path, **pipe_line_args).to(device)
+
+    if xformers:
+        pipe.enable_xformers_memory_efficient_attention()
+
+    if folded_frame_layout or channels_last:
+        pipe.unet.enable_folded_frame_layout(channels_last=channels_last)
+
+    if compile_cache_dir:
+        set_compile_cache_dir(compile_cache_dir)
+
+    if compile_models:
+        # compilation happens lazily, on the first call at every new shape, see `warmup`
+        pipe.unet = pipe.unet.compile_for_inference(max_shapes=compile_max_shapes)
+        pipe.vae.decoder = torch.compile(pipe.vae.decoder)
+
+    return pipe
+
+
+def set_compile_cache_dir(cache_dir: str):
+    """
+    Keeps the kernels generated by torch.compile (and the compiled graphs, on torch versions with an FX graph
+    cache) in `cache_dir`, so a restarted process reuses them instead of compiling everything again.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(cache_dir, "inductor")
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+    import torch._inductor.config
+    if hasattr(torch._inductor.config, "fx_graph_cache"):
+        torch._inductor.config.fx_graph_cache = os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] == "1"
+
+
+def set_scheduler(pipe, scheduler: str = 'EulerAncestralDiscreteScheduler'):
+    SchedulerClass = SCHEDULERS[scheduler]
+    if SchedulerClass is not None and type(pipe.scheduler) is not SchedulerClass:
+        pipe.scheduler = SchedulerClass.from_config(pipe.scheduler.config)
+
 
-    if args.lora:
-        
-        if args.weight_name == "NO SAFETENSORS FILE": 
+@dataclass
+class GenerationRequest:
+    """
+    A single generation request. The fields mirror the generation related command line arguments of this script.
+    """
+    output: str
+    prompt: str = "a bulldog in the captains chair of a spaceship, hd, high quality"
+    negative_prompt: Optional[str] = "blurry"
+    lora: Optional[str] = None
+    weight_name: Optional[str] = None
+    steps: int = 30
+    seed: int = 455
+    width: int = 672
+    height: int = 384
+    target_width: int = 512
+    target_height: int = 512
+    og_width: int = 1920
+    og_height: int = 1080
+    video_length: int = 8
+    video_duration: int = 1000
+    low_vram_mode: bool = False
+    offload_reserve_bytes: Optional[int] = None
+    scheduler: str = 'EulerAncestralDiscreteScheduler'
+    # a single value for all controlnets or one value per controlnet
+    controlnet_conditioning_scale: Union[float, Sequence[float]] = 0.7
+    control_guidance_start: Union[float, Sequence[float]] = 0.0
+    control_guidance_end: Union[float, Sequence[float]] = 1.0
+    controlnet_cache_steps: int = 1
+    # a single gif, or one gif per controlnet in the order of the controlnets
+    gif: Optional[Union[str, Sequence[str]]] = None
+    autocast: Optional[str] = None
+    decode_chunk_size: Union[int, str] = "auto"
+    context_length: Optional[int] = None
+    context_stride: Optional[int] = None
+    deep_cache_interval: Optional[int] = None
+    deep_cache_depth: int = 1
+    cfg_end: Optional[float] = None
+    cfg_interval: int = 1
+
+    def __post_init__(self):
+        if self.weight_name == "NO SAFETENSORS FILE":
+            self.weight_name = None
+
+        # tuples, so the per controlnet values can be part of `batch_key()`
+        for name in ("controlnet_conditioning_scale", "control_guidance_start", "control_guidance_end"):
+            value = getattr(self, name)
+            if isinstance(value, (list, tuple)):
+                setattr(self, name, tuple(float(v) for v in value))
+
+        if isinstance(self.gif, (list, tuple)):
+            self.gif = tuple(self.gif)
+
+    def batch_key(self):
+        """
+        Requests with the same key can be denoised together in one batch. Only the output path, the prompts and
+        the seed may differ within a batch.
+        """
+        return (
+            self.lora, self.weight_name, self.steps, self.width, self.height, self.target_width, self.target_height,
+            self.og_width, self.og_height, self.video_length, self.video_duration, self.low_vram_mode,
+            self.offload_reserve_bytes, self.scheduler, self.controlnet_conditioning_scale, self.control_guidance_start,
+            self.control_guidance_end, self.controlnet_cache_steps, self.gif, self.autocast, self.decode_chunk_size, self.context_length,
+            self.context_stride, self.deep_cache_interval, self.deep_cache_depth, self.cfg_end, self.cfg_interval,
+            self.negative_prompt is None,
+        )
+
+
+def per_controlnet(value: Union[float, Sequence[float]], num_controlnets: int) -> Union[float, List[float]]:
+    """
+    Brings a `GenerationRequest` control value into the format the controlnet pipeline expects: a float for a
+    single controlnet and a list with one value per controlnet for several of them.
+    """
+    values = [float(v) for v in value] if isinstance(value, (list, tuple)) else [float(value)]
+
+    if len(values) == 1:
+        values = values * num_controlnets
+    elif len(values) != num_controlnets:
+        raise ValueError(f"Expected a single value or {num_controlnets} values (one per controlnet) but got {len(values)}")
+
+    return values[0] if num_controlnets == 1 else values
+
+
+def load_control_images(gif: str,
+                        request: GenerationRequest,
+                        control_frame_cache: ControlFrameCache = None) -> List[Image.Image]:
+    """
+    Extracts the control frames of `gif` for the size and video length of `request`, through
+    `control_frame_cache` if one is given.
+    """
+    if control_frame_cache is not None:
+        return control_frame_cache.load_images(gif,
+                                               fps=request.video_length,
+                                               target_duration=request.video_duration,
+                                               width=request.width,
+                                               height=request.height)
+
+    return [
+        scale_aspect_fill(img, request.width, request.height).convert("RGB") \
+        for img in
+        extract_gif_frames_from_midpoint(gif, fps=request.video_length, target_duration=request.video_duration)
+    ]
+
+
+def open_video_writer(request: GenerationRequest):
+    duration = request.video_duration // request.video_length
+    if request.output.split(".")[-1] == "gif":
+        return GifWriter(request.output, duration=duration)
+    return Mp4Writer(request.output, duration=duration)
+
+
+def generate(pipe,
+             output: str,
+             lora_cache: LoraCache = None,
+             control_frame_cache: ControlFrameCache = None,
+             **kwargs) -> str:
+    """
+    Runs a single generation on an already loaded pipeline and writes the result to `output`. The keyword
+    arguments are the fields of `GenerationRequest`.
+
+    Without a `lora_cache`, a LoRA passed via `lora` is only attached for the duration of the call, so the
+    pipeline is left untouched for the next request. With a `lora_cache`, the parsed LoRA is kept in memory and
+    stays attached until a different one (or none) is requested. With a `control_frame_cache`, the control
+    frames of a `gif` are extracted only once for every size and video length.
+    """
+    return generate_batch(pipe,
+                          [GenerationRequest(output=output, **kwargs)],
+                          lora_cache=lora_cache,
+                          control_frame_cache=control_frame_cache)[0]
+
+
+def generate_batch(pipe,
+                   requests: List[GenerationRequest],
+                   lora_cache: LoraCache = None,
+                   control_frame_cache: ControlFrameCache = None) -> List[str]:
+    """
+    Runs several requests sharing the same `GenerationRequest.batch_key()` in a single batched denoising loop
+    and writes each result to its own `output`. Every request keeps its own generator, so a request produces the
+    same result whether it's run alone or as part of a batch.
+    """
+    first = requests[0]
+    if any(request.batch_key() != first.batch_key() for request in requests):
+        raise ValueError("All requests in a batch need to have the same `batch_key()`.")
+
+    if len(requests) > 1 and type(pipe) is HotshotXLControlNetPipeline:
+        # the control frames are only prepared for a single video
+        return [
+            output
+            for request in requests
+            for output in generate_batch(pipe, [request], lora_cache=lora_cache, control_frame_cache=control_frame_cache)
+        ]
+
+    for request in requests:
+        output_dir = os.path.dirname(request.output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+    set_scheduler(pipe, first.scheduler)
+
+    if len(requests) == 1:
+        prompt = first.prompt
+        negative_prompt = first.negative_prompt
+        generator = torch.Generator().manual_seed(first.seed) if first.seed else None
+    else:
+        prompt = [request.prompt for request in requests]
+        negative_prompt = None if first.negative_prompt is None else [request.negative_prompt for request in requests]
+        # a batched call needs a generator for every request, so unseeded requests get a random seed
+        generator = [
+            torch.Generator().manual_seed(request.seed if request.seed else random.randrange(2 ** 63))
+            for request in requests
+        ]
+
+    autocast_type = AUTOCAST_TYPES.get(first.autocast)
+
+    if type(pipe) is HotshotXLControlNetPipeline:
+        kwargs = {
+            "low_vram_mode": first.low_vram_mode,
+            "offload_reserve_bytes": first.offload_reserve_bytes,
+            "controlnet_cache_steps": first.controlnet_cache_steps,
+        }
+    else:
+        kwargs = {
+            "low_vram_mode": first.low_vram_mode,
+            "offload_reserve_bytes": first.offload_reserve_bytes,
+            "context_length": first.context_length,
+            "context_stride": first.context_stride,
+            "deep_cache_interval": first.deep_cache_interval,
+            "deep_cache_depth": first.deep_cache_depth,
+            "cfg_end": first.cfg_end,
+            "cfg_interval": first.cfg_interval,
+        }
+
+    if first.gif and type(pipe) is HotshotXLControlNetPipeline:
+        num_controlnets = len(getattr(pipe.controlnet, "nets", [pipe.controlnet]))
+        gifs = [first.gif] if isinstance(first.gif, str) else list(first.gif)
+        if len(gifs) != num_controlnets:
+            raise ValueError(f"Expected one gif per controlnet ({num_controlnets}) but got {len(gifs)}")
+
+        # every controlnet is conditioned on the frames of its own gif, e.g. a depth map and an edge map
+        control_images = [load_control_images(gif, first, control_frame_cache) for gif in gifs]
+        kwargs['control_images'] = control_images[0] if num_controlnets == 1 else control_images
+        kwargs['controlnet_conditioning_scale'] = per_controlnet(first.controlnet_conditioning_scale, num_controlnets)
+        kwargs['control_guidance_start'] = per_controlnet(first.control_guidance_start, num_controlnets)
+        kwargs['control_guidance_end'] = per_controlnet(first.control_guidance_end, num_controlnets)
+
+    lora, weight_name = first.lora, first.weight_name
+
+    if lora_cache is not None:
+        lora_cache.activate(pipe, lora, weight_name)
+    elif lora:
+        if weight_name is None:
             pipe.load_lora_weights(
-                args.lora,     
+                lora,
                 low_cpu_mem_usage = True,
                 #use_auth_token = True
             )
-    
+
         else:
             pipe.load_lora_weights(
-                args.lora,
-                weight_name = args.weight_name,        
+                lora,
+                weight_name = weight_name,
                 low_cpu_mem_usage = True,
                 #use_auth_token = True
             )
 
-    SchedulerClass = SCHEDULERS[args.scheduler]
-    if SchedulerClass is not None:
-        pipe.scheduler = SchedulerClass.from_config(pipe.scheduler.config)
- 
-    if args.xformers:
-        pipe.enable_xformers_memory_efficient_attention()
+    # frames are streamed out one decoded chunk at a time, in order, one video after the other,
+    # and handed to the encoders right away
+    writers = {}
+    num_frames = 0
+
+    with ExitStack() as stack:
+        try:
+            with maybe_auto_cast(autocast_type):
+
+                for chunk in pipe.stream(prompt,
+                                         negative_prompt=negative_prompt,
+                                         width=first.width,
+                                         height=first.height,
+                                         original_size=(first.og_width, first.og_height),
+                                         target_size=(first.target_width, first.target_height),
+                                         num_inference_steps=first.steps,
+                                         video_length=first.video_length,
+                                         generator=generator,
+                                         decode_chunk_size=first.decode_chunk_size,
+                                         output_type="uint8",
+                                         **kwargs):
+                    for frame in chunk:
+                        request = requests[num_frames // first.video_length]
+                        num_frames += 1
+
+                        if request.video_length == 1:
+                            Image.fromarray(frame).save(request.output, format='JPEG', quality=95)
+                            continue
+
+                        if request.output not in writers:
+                            writers[request.output] = stack.enter_context(open_video_writer(request))
+                        writers[request.output].append(frame)
+        finally:
+            if lora and lora_cache is None:
+                pipe.unload_lora_weights()
+
+    return [request.output for request in requests]
+
+
+def warmup(pipe,
+           sizes: Sequence[Tuple[int, int]],
+           video_lengths: Sequence[int] = (8,),
+           batch_sizes: Sequence[int] = (1,),
+           steps: int = 2,
+           **kwargs) -> Dict[Tuple[int, int, int, int], float]:
+    """
+    Runs a short generation for every `(width, height)` in `sizes`, every video length and every batch size, so
+    a compiled pipeline traces and compiles its graphs for each of them before the first real request arrives.
+    Additional keyword arguments are passed on to `GenerationRequest` and should match the ones used when
+    serving. Returns the time it took for each `(width, height, video_length, batch_size)` in seconds.
+    """
+    timings = {}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for width, height in sizes:
+            for video_length in video_lengths:
+                for batch_size in batch_sizes:
+                    requests = [
+                        GenerationRequest(output=os.path.join(output_dir, f"warmup_{i}.mp4"),
+                                          prompt="warmup",
+                                          width=width,
+                                          height=height,
+                                          video_length=video_length,
+                                          steps=steps,
+                                          seed=i + 1,
+                                          **kwargs)
+                        for i in range(batch_size)
+                    ]
+
+                    start = time.perf_counter()
+                    generate_batch(pipe, requests)
+                    timings[(width, height, video_length, batch_size)] = time.perf_counter() - start
+
+                    print(f"warmup {width}x{height}, {video_length} frames, batch size {batch_size}: "
+                          f"{timings[(width, height, video_length, batch_size)]:.1f}s")
+
+    print(f"warmup took {sum(timings.values()):.1f}s")
+
+    return timings
 
-    generator = torch.Generator().manual_seed(args.seed) if args.seed else None
 
-    autocast_type = None
-    if args.autocast == 'f16':
-        autocast_type = torch.half
-    elif args.autocast == 'bf16':
-        autocast_type = torch.bfloat16
+def main():
+    args = parse_args()
 
-    if type(pipe) is HotshotXLControlNetPipeline:
-        kwargs = {}
-    else:
-        kwargs = {
-            "low_vram_mode": args.low_vram_mode
-        }
+    if args.control_type and not args.gif:
+        raise ValueError("Controlnet specified but you didn't specify a gif!")
 
-    if args.gif and type(pipe) is HotshotXLControlNetPipeline:
-        kwargs['control_images'] = [
-            scale_aspect_fill(img, args.width, args.height).convert("RGB") \
-            for img in
-            extract_gif_frames_from_midpoint(args.gif, fps=args.video_length, target_duration=args.video_duration)
-        ]
-        kwargs['controlnet_conditioning_scale'] = args.controlnet_conditioning_scale
-        kwargs['control_guidance_start'] = args.control_guidance_start
-        kwargs['control_guidance_end'] = args.control_guidance_end
-
-    with maybe_auto_cast(autocast_type):
-
-        images = pipe(args.prompt,
-                      negative_prompt=args.negative_prompt,
-                      width=args.width,
-                      height=args.height,
-                      original_size=(args.og_width, args.og_height),
-                      target_size=(args.target_width, args.target_height),
-                      num_inference_steps=args.steps,
-                      video_length=args.video_length,
-                      generator=generator,
-                      output_type="tensor", **kwargs).videos
-
-    images = to_pil_images(images, output_type="pil")
-
-    if args.video_length > 1:
-        if args.output.split(".")[-1] == "gif":
-            save_as_gif(images, args.output, duration=args.video_duration // args.video_length)
-        else:
-            save_as_mp4(images, args.output, duration=args.video_duration // args.video_length)
-    else:
-        images[0].save(args.output, format='JPEG', quality=95)
+    if args.gif and not args.control_type:
+        print("warning: gif was specified but no control type was specified. gif will be ignored.")
+
+    if args.gif and args.control_type and len(args.gif) != len(args.control_type):
+        raise ValueError(f"Specify one gif per control type, got {len(args.gif)} gifs for "
+                         f"{len(args.control_type)} control types.")
+
+    pipe = load_pipeline(pretrained_path=args.pretrained_path,
+                         spatial_unet_base=args.spatial_unet_base,
+                         control_type=args.control_type,
+                         precision=args.precision,
+                         xformers=args.xformers,
+                         folded_frame_layout=args.folded_frame_layout,
+                         channels_last=args.channels_last,
+                         compile_models=args.compile,
+                         compile_cache_dir=args.compile_cache_dir,
+                         compile_max_shapes=args.compile_max_shapes)
+
+    control_frame_cache = ControlFrameCache(args.control_cache_dir) if args.control_cache_dir else None
+
+    generate(pipe,
+             output=args.output,
+             control_frame_cache=control_frame_cache,
+             prompt=args.prompt,
+             negative_prompt=args.negative_prompt,
+             lora=args.lora,
+             weight_name=args.weight_name,
+             steps=args.steps,
+             seed=args.seed,
+             width=args.width,
+             height=args.height,
+             target_width=args.target_width,
+             target_height=args.target_height,
+             og_width=args.og_width,
+             og_height=args.og_height,
+             video_length=args.video_length,
+             video_duration=args.video_duration,
+             low_vram_mode=args.low_vram_mode,
+             offload_reserve_bytes=args.offload_reserve_bytes,
+             scheduler=args.scheduler,
+             controlnet_conditioning_scale=args.controlnet_conditioning_scale,
+             control_guidance_start=args.control_guidance_start,
+             control_guidance_end=args.control_guidance_end,
+             controlnet_cache_steps=args.controlnet_cache_steps,
+             gif=args.gif,
+             autocast=args.autocast,
+             decode_chunk_size=args.decode_chunk_size,
+             context_length=args.context_length,
+             context_stride=args.context_stride,
+             deep_cache_interval=args.deep_cache_interval,
+             deep_cache_depth=args.deep_cache_depth,
+             cfg_end=args.cfg_end,
+             cfg_interval=args.cfg_interval)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from hotshot_xl.models.unet import UNet3DConditionModel
+
+
+def make_tiny_unet(layers_per_block: int = 1) -> UNet3DConditionModel:
+    torch.manual_seed(0)
+    return UNet3DConditionModel(
+        sample_size=16,
+        block_out_channels=(32, 32, 64),
+        layers_per_block=layers_per_block,
+        cross_attention_dim=16,
+        attention_head_dim=2,
+    ).eval()
+
+
+@pytest.fixture
+def tiny_unet():
+    return make_tiny_unet()
+
+
+def make_unet_inputs(batch_size: int = 1, frames: int = 3, size: int = 16, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randn(batch_size, 4, frames, size, size, generator=generator)
+    encoder_hidden_states = torch.randn(batch_size, 5, 16, generator=generator)
+    return sample, encoder_hidden_states
@@ -0,0 +1,18 @@
+import pytest
+
+from hotshot_xl.pipelines.hotshot_xl_pipeline import HotshotXLPipeline
+
+
+@pytest.mark.parametrize("video_length, context_length, context_stride", [(16, 8, None), (20, 8, 3), (9, 1, 1)])
+def test_context_windows_cover_every_frame(video_length, context_length, context_stride):
+    windows = HotshotXLPipeline.get_context_windows(video_length, context_length, context_stride)
+
+    assert all(window.stop - window.start == context_length for window in windows)
+    assert windows[-1].stop == video_length
+    assert {frame for window in windows for frame in range(window.start, window.stop)} == set(range(video_length))
+
+
+@pytest.mark.parametrize("context_length, context_stride", [(0, None), (-4, None), (8, 0), (8, -2), (4, 8)])
+def test_context_windows_reject_invalid_values(context_length, context_stride):
+    with pytest.raises(ValueError):
+        HotshotXLPipeline.get_context_windows(16, context_length, context_stride)
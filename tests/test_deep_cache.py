@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from conftest import make_tiny_unet, make_unet_inputs
+
+
+def count_calls(module):
+    calls = []
+    module.register_forward_hook(lambda *args: calls.append(1))
+    return calls
+
+
+@pytest.mark.parametrize("layers_per_block", [1, 2])
+@pytest.mark.parametrize("depth", [1, 2])
+def test_deep_cache_matches_uncached_pass_at_same_timestep(depth, layers_per_block):
+    unet = make_tiny_unet(layers_per_block)
+    unet.enable_deep_cache(depth=depth)
+    sample, encoder_hidden_states = make_unet_inputs()
+    mid_block_calls = count_calls(unet.mid_block)
+
+    with torch.no_grad():
+        expected = unet(sample, 10, encoder_hidden_states).sample
+        output = unet(sample, 10, encoder_hidden_states, use_deep_cache=True).sample
+
+    # the cached pass skipped the mid block, and only recomputed the outer blocks on the same input
+    assert len(mid_block_calls) == 1
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("depth", [1, 2])
+def test_deep_cache_falls_back_to_full_pass_on_shape_change(depth):
+    unet = make_tiny_unet()
+    unet.enable_deep_cache(depth=depth)
+    mid_block_calls = count_calls(unet.mid_block)
+
+    sample, encoder_hidden_states = make_unet_inputs(frames=3)
+    other_sample, other_encoder_hidden_states = make_unet_inputs(batch_size=2, frames=2, seed=1)
+
+    with torch.no_grad():
+        unet(sample, 10, encoder_hidden_states)
+        output = unet(other_sample, 10, other_encoder_hidden_states, use_deep_cache=True).sample
+
+        unet.disable_deep_cache()
+        expected = unet(other_sample, 10, other_encoder_hidden_states).sample
+
+    assert len(mid_block_calls) == 3
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_deep_cache_depth_is_validated(tiny_unet):
+    with pytest.raises(ValueError):
+        tiny_unet.enable_deep_cache(depth=len(tiny_unet.up_blocks))
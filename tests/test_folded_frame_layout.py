@@ -0,0 +1,60 @@
+import pytest
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from conftest import make_tiny_unet, make_unet_inputs
+
+
+class LayoutCopyCounter(TorchDispatchMode):
+    """
+    Counts the bytes copied to change the memory layout of activations: explicit copies (`clone`, `copy_`, which
+    is what `contiguous()` and non-view `rearrange`s dispatch to) and the inputs of convolutions and group norms
+    that aren't dense, which these kernels copy internally.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.copies = 0
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        name = func.overloadpacket.__name__
+        if name in ("convolution", "native_group_norm") and not self._is_dense(args[0]):
+            self._count(args[0])
+
+        output = func(*args, **(kwargs or {}))
+
+        if name in ("clone", "copy_"):
+            self._count(output)
+
+        return output
+
+    @staticmethod
+    def _is_dense(tensor):
+        return tensor.is_contiguous() or tensor.is_contiguous(memory_format=torch.channels_last)
+
+    def _count(self, tensor):
+        self.copies += 1
+        self.bytes += tensor.numel() * tensor.element_size()
+
+
+def run_unet(folded_frame_layout: bool, channels_last: bool = False):
+    unet = make_tiny_unet()
+    if folded_frame_layout:
+        unet.enable_folded_frame_layout(channels_last=channels_last)
+    sample, encoder_hidden_states = make_unet_inputs(frames=8)
+
+    with torch.no_grad(), LayoutCopyCounter() as counter:
+        output = unet(sample, 10, encoder_hidden_states).sample
+
+    return output, counter
+
+
+@pytest.mark.parametrize("channels_last", [False, True])
+def test_folded_frame_layout_matches_and_copies_less(channels_last):
+    expected, unfolded = run_unet(folded_frame_layout=False)
+    output, folded = run_unet(folded_frame_layout=True, channels_last=channels_last)
+
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-4)
+    assert folded.copies < unfolded.copies
+    assert folded.bytes < unfolded.bytes / 2
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from conftest import make_tiny_unet, make_unet_inputs
+
+
+@pytest.mark.parametrize("setup", ["default", "deep_cache", "folded_frame_layout"])
+def test_unet_forward_has_no_graph_breaks(setup):
+    unet = make_tiny_unet()
+    sample, encoder_hidden_states = make_unet_inputs()
+    kwargs = {}
+
+    if setup == "deep_cache":
+        # the full pass stores the deep features from inside the forward pass, the cached pass reads them
+        unet.enable_deep_cache(depth=1)
+        with torch.no_grad():
+            unet(sample, 10, encoder_hidden_states)
+        kwargs["use_deep_cache"] = True
+    elif setup == "folded_frame_layout":
+        unet.enable_folded_frame_layout()
+
+    with torch.no_grad():
+        report = unet.graph_break_report(sample, torch.tensor(10), encoder_hidden_states, **kwargs)
+
+    assert report["graph_break_count"] == 0, report["break_reasons"]
+    assert report["graph_count"] == 1
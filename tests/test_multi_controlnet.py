@@ -0,0 +1,77 @@
+import torch
+from diffusers.models import ControlNetModel
+from diffusers.pipelines.controlnet.multicontrolnet import MultiControlNetModel
+
+from hotshot_xl.pipelines.hotshot_xl_controlnet_pipeline import HotshotXLControlNetPipeline
+
+
+def make_tiny_controlnet(seed: int) -> ControlNetModel:
+    torch.manual_seed(seed)
+    return ControlNetModel(
+        block_out_channels=(32, 64),
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        layers_per_block=1,
+        cross_attention_dim=16,
+        attention_head_dim=2,
+        norm_num_groups=8,
+        conditioning_embedding_out_channels=(16, 32),
+    ).eval()
+
+
+def make_pipeline(nets) -> HotshotXLControlNetPipeline:
+    # `run_controlnets` only needs the controlnet, skip loading all the other components
+    pipe = HotshotXLControlNetPipeline.__new__(HotshotXLControlNetPipeline)
+    pipe.controlnet = MultiControlNetModel(nets)
+    return pipe
+
+
+def make_inputs(num_nets: int):
+    generator = torch.Generator().manual_seed(0)
+    sample = torch.randn(2, 4, 8, 8, generator=generator)
+    encoder_hidden_states = torch.randn(2, 5, 16, generator=generator)
+    images = [torch.rand(2, 3, 16, 16, generator=generator) for _ in range(num_nets)]
+    return sample, encoder_hidden_states, images
+
+
+def test_run_controlnets_sums_the_residuals_of_all_nets():
+    nets = [make_tiny_controlnet(seed) for seed in range(3)]
+    pipe = make_pipeline(nets)
+    sample, encoder_hidden_states, images = make_inputs(len(nets))
+    scales = [0.5, 1.0, 0.8]
+
+    with torch.no_grad():
+        down_samples, mid_sample = pipe.run_controlnets(
+            sample, 10, encoder_hidden_states=encoder_hidden_states, controlnet_cond=images, conditioning_scale=scales
+        )
+
+        outputs = [
+            net(sample, 10, encoder_hidden_states=encoder_hidden_states, controlnet_cond=image,
+                conditioning_scale=scale, return_dict=False)
+            for net, image, scale in zip(nets, images, scales)
+        ]
+
+    for i, down_sample in enumerate(down_samples):
+        torch.testing.assert_close(down_sample, sum(output[0][i] for output in outputs))
+    torch.testing.assert_close(mid_sample, sum(output[1] for output in outputs))
+
+
+def test_run_controlnets_skips_zero_scale_nets():
+    nets = [make_tiny_controlnet(seed) for seed in range(2)]
+    pipe = make_pipeline(nets)
+    sample, encoder_hidden_states, images = make_inputs(len(nets))
+
+    calls = []
+    nets[0].register_forward_hook(lambda *args: calls.append(1))
+
+    with torch.no_grad():
+        down_samples, mid_sample = pipe.run_controlnets(
+            sample, 10, encoder_hidden_states=encoder_hidden_states, controlnet_cond=images, conditioning_scale=[0.0, 1.0]
+        )
+        expected_down_samples, expected_mid_sample = nets[1](
+            sample, 10, encoder_hidden_states=encoder_hidden_states, controlnet_cond=images[1], return_dict=False
+        )
+
+    assert not calls
+    for down_sample, expected in zip(down_samples, expected_down_samples):
+        torch.testing.assert_close(down_sample, expected)
+    torch.testing.assert_close(mid_sample, expected_mid_sample)
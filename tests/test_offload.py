@@ -0,0 +1,29 @@
+import torch
+
+from hotshot_xl.pipelines.offload import ModelOffloader
+
+
+def test_repeated_offloads_reuse_pinned_buffers():
+    torch.manual_seed(0)
+    offloader = ModelOffloader("cpu")
+    modules = {"vae": torch.nn.Linear(8, 8), "text_encoder": torch.nn.Linear(8, 8)}
+    expected = {name: module.weight.detach().clone() for name, module in modules.items()}
+
+    for name, module in modules.items():
+        offloader.register(name, module)
+
+    pinned = None
+    # every `require` offloads the other component, like consecutive low vram requests
+    for _ in range(2):
+        offloader.require("vae")
+        assert offloader.is_resident("vae") and not offloader.is_resident("text_encoder")
+
+        offloader.require("text_encoder")
+        assert offloader.is_resident("text_encoder") and not offloader.is_resident("vae")
+
+        if pinned is None:
+            pinned = modules["vae"].weight.data_ptr()
+        assert modules["vae"].weight.data_ptr() == pinned
+
+    for name, module in modules.items():
+        torch.testing.assert_close(module.weight, expected[name])
@@ -0,0 +1,53 @@
+import pytest
+import torch
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+from hotshot_xl.models.transformer_temporal import TemporalAttention, TemporalAttnProcessor2_0, TransformerTemporal
+
+
+@pytest.mark.parametrize("number_of_frames", [1, 8, 30])
+def test_temporal_processor_matches_rearranged_attention(number_of_frames):
+    torch.manual_seed(0)
+    attention = TemporalAttention(query_dim=32, heads=4, dim_head=8).eval()
+    assert isinstance(attention.processor, TemporalAttnProcessor2_0)
+
+    batch_size, sequence_length = 2, 6
+    hidden_states = torch.randn(batch_size * number_of_frames, sequence_length, 32)
+
+    with torch.no_grad():
+        output = attention(hidden_states, number_of_frames=number_of_frames)
+
+        # the `(b s) f c` fallback used by every other processor
+        attention.set_processor(AttnProcessor2_0())
+        expected = attention(hidden_states, number_of_frames=number_of_frames)
+
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("processor", [TemporalAttnProcessor2_0, AttnProcessor2_0])
+def test_temporal_attention_leaves_the_input_unchanged_by_default(processor):
+    torch.manual_seed(0)
+    attention = TemporalAttention(query_dim=32, heads=4, dim_head=8, processor=processor()).eval()
+    hidden_states = torch.randn(2, 6, 32)
+    expected = hidden_states.clone()
+
+    with torch.no_grad():
+        attention(hidden_states, number_of_frames=1)
+
+    torch.testing.assert_close(hidden_states, expected, rtol=0, atol=0)
+
+
+def test_transformer_temporal_matches_rearranged_attention():
+    torch.manual_seed(0)
+    transformer = TransformerTemporal(num_attention_heads=2, attention_head_dim=8, in_channels=16, norm_num_groups=4).eval()
+    sample = torch.randn(2, 16, 8, 4, 4)
+
+    with torch.no_grad():
+        output = transformer(sample)
+
+        for module in transformer.modules():
+            if isinstance(module, TemporalAttention):
+                module.set_processor(AttnProcessor2_0())
+        expected = transformer(sample)
+
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
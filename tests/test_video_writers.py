@@ -0,0 +1,35 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from hotshot_xl.utils import Mp4Writer
+
+
+def random_frames(count: int, size: int = 128):
+    generator = np.random.default_rng(0)
+    return [generator.integers(0, 256, (size, size, 3), dtype=np.uint8) for _ in range(count)]
+
+
+class DisconnectedTarget:
+    def write(self, data):
+        raise BrokenPipeError("client disconnected")
+
+
+def test_mp4_writer_streams_to_file_object():
+    target = BytesIO()
+    with Mp4Writer(target, duration=125) as writer:
+        for frame in random_frames(8):
+            writer.append(frame)
+
+    assert target.getvalue()[4:8] == b"ftyp"
+
+
+def test_mp4_writer_raises_when_the_target_fails():
+    # noise compresses badly, so ffmpeg's output would fill a pipe nobody reads and block `append`
+    frames = random_frames(4, size=256)
+
+    with pytest.raises(BrokenPipeError):
+        with Mp4Writer(DisconnectedTarget(), duration=125) as writer:
+            for i in range(200):
+                writer.append(frames[i % len(frames)])